@@ -0,0 +1,255 @@
+"""
+Run OpenAPS oref0 autotune on Nightscout data for multiple history
+ranges in parallel.
+
+The profile and the longest range are downloaded once and served to
+oref0-autotune from a local replay endpoint, so each range does not
+download the same history again.
+
+Usage: ./nightscout_autotune.py https://example.nightscout.site
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+from datetime import date, datetime, timedelta
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+import nightscout_to_json
+
+
+DAYS = (1, 8, 15)
+ITERATIONS = 1
+OREF0_PATH = '/node_modules/oref0/bin/'
+
+# fields the replay endpoint filters on, all map to the document time
+DATE_FIELDS = ('date', 'dateString', 'created_at', 'sysTime')
+
+# treatments Nightscout returns without a count, without and with a find,
+# entries are 10 like the default of find()
+TREATMENT_COUNTS = (100, 1000)
+
+
+def openaps_profile(profile):
+    """Convert a Nightscout profile document like nightscout_to_openaps.js."""
+    p = profile['store'][profile['defaultProfile']]
+    return {
+        'min_5m_carbimpact': 8.0,
+        'dia': float(p['dia']),
+        'basalprofile': [{
+            'start': x['time'] + ':00',
+            'minutes': round(nightscout_to_json.schedule_seconds(x) / 60),
+            'rate': x['value'],
+        } for x in p['basal']],
+        'isfProfile': {
+            'sensitivities': [{
+                'i': 0,
+                'start': p['sens'][0]['time'] + ':00',
+                'sensitivity': float(p['sens'][0]['value']),
+                'offset': 0,
+                'x': 0,
+                'endOffset': 1440,
+            }],
+        },
+        'carb_ratio': float(p['carbratio'][0]['value']),
+        'curve': 'ultra-rapid',
+        'autosens_max': 2.0,
+        'autosens_min': 0.1,
+    }
+
+
+class Replay(object):
+    """Documents of one collection, newest first, with their epochs."""
+
+    def __init__(self, docs, field):
+        ts = np.array([nightscout_to_json.parse_ts(d[field]) for d in docs],
+                      dtype=np.int64)
+        order = np.argsort(-ts, kind='stable')
+        self.ts = -ts[order]
+        self.docs = [docs[i] for i in order]
+
+    def find(self, params, count=10):
+        """Filter like the Nightscout API v1 with find[..][$gte/$lte] and count.
+
+        Every find on a date field (date in ms, dateString, created_at)
+        filters on the document time, other conditions are ignored. count
+        is the number of documents returned without a count parameter.
+        """
+        lo = None
+        hi = None
+        for k, v in params.items():
+            if not k.startswith('find[') or k[5:k.find(']')] not in DATE_FIELDS:
+                continue
+            ts = int(v) // 1000 if v.isdigit() else nightscout_to_json.parse_ts(v)
+            if k.endswith('[$gte]'):
+                lo = ts
+            elif k.endswith('[$gt]'):
+                lo = ts + 1
+            elif k.endswith('[$lte]'):
+                hi = ts
+            elif k.endswith('[$lt]'):
+                hi = ts - 1
+        # self.ts holds negated epochs in ascending order
+        first = 0 if hi is None else np.searchsorted(self.ts, -hi, side='left')
+        last = len(self.ts) if lo is None else np.searchsorted(self.ts, -lo, side='right')
+        count = int(params.get('count', count))
+        return self.docs[first:last][:count]
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path
+        if path.startswith('/api/v1/'):
+            path = path[len('/api/v1/'):]
+        path = path.rsplit('.json', 1)[0]
+        if path == 'profile':
+            docs = self.server.profile
+        elif path in ('entries', 'entries/sgv'):
+            docs = self.server.entries.find(params)
+        elif path == 'treatments':
+            find = any(k.startswith('find[') for k in params)
+            docs = self.server.treatments.find(params, TREATMENT_COUNTS[find])
+        else:
+            docs = []
+        body = json.dumps(docs).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(profile, entries, treatments):
+    """Start a replay endpoint on a free local port, returns the server."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ReplayHandler)
+    server.profile = profile
+    server.entries = Replay(entries, 'dateString')
+    server.treatments = Replay(treatments, 'created_at')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def autotune(host, output, days, iterations, profile):
+    """Run the iterations for one history range, returns a result dict."""
+    started = time.time()
+    start = (date.today() - timedelta(days=days)).isoformat()
+    end = (date.today() - timedelta(days=1)).isoformat()
+    base = os.path.join(output, str(days))
+    if os.path.isdir(base):
+        shutil.rmtree(base)
+    settings = os.path.join(base, 'settings')
+    target = os.path.join(base, 'autotune')
+    os.makedirs(settings)
+    os.makedirs(target)
+    for fn in ('profile.json', 'pumpprofile.json', 'autotune.json'):
+        with open(os.path.join(settings, fn), 'w') as f:
+            json.dump(profile, f, indent=2)
+
+    report = ['-- %s - %s --' % (start, end)]
+    ok = True
+    env = dict(os.environ, PATH=OREF0_PATH + ':/usr/local/bin:' + os.environ.get('PATH', ''))
+    for i in range(1, iterations + 1):
+        report.append('-------- Iteration %d --------' % i)
+        log_fn = os.path.join(target, '%d.log' % i)
+        with open(log_fn, 'w') as log:
+            returncode = subprocess.call([
+                'oref0-autotune', '--dir=' + base, '--ns-host=' + host,
+                '--start-date=' + start, '--end-date=' + end,
+                '--tune-insulin-curve=true'],
+                stdout=log, stderr=subprocess.STDOUT, env=env)
+        if returncode != 0:
+            report.append(open(log_fn).read())
+            ok = False
+            break
+        shutil.copy(os.path.join(target, 'profile.json'),
+                    os.path.join(settings, 'pumpprofile.json'))
+        report.append(open(os.path.join(target, 'autotune_recommendations.log')).read())
+    return {
+        'days': days,
+        'ok': ok,
+        'report': '\n'.join(report),
+        'seconds': time.time() - started,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', type=str, help='nightscout url')
+    parser.add_argument('--token', type=str, help='nightscout access token')
+    parser.add_argument('--days', type=int, nargs='+', default=DAYS,
+                        help='history ranges to tune, in days')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parallel autotune runs, defaults to one per range')
+    parser.add_argument('--output', type=str,
+                        default=os.path.join(os.getcwd(), 'runfiles'))
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    dl = nightscout_to_json.connect(args.url, token=args.token)
+    profile = dl.download('profile')
+    # What oref0-autotune (0.7) queries, in the local time of this host
+    # like its dates: treatments from 4 hours before the start date until
+    # the end of the end date, entries from 4am to 4am of each day, so up
+    # to 4am today. One more hour on both sides.
+    today = datetime.combine(date.today(), datetime.min.time())
+    startdate = (today - timedelta(days=max(args.days), hours=5)).astimezone()
+    enddate = (today + timedelta(hours=5)).astimezone()
+    entries = dl.download_range('entries', 'dateString', startdate, enddate)
+    treatments = dl.download_range('treatments', 'created_at', startdate, enddate)
+    fetched = time.time() - started
+
+    server = serve(profile, entries, treatments)
+    host = 'http://127.0.0.1:%d' % server.server_address[1]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.workers or len(args.days)) as executor:
+        results = list(executor.map(
+            lambda days: autotune(host, args.output, days, args.iterations,
+                                  openaps_profile(profile[0])),
+            args.days))
+    server.shutdown()
+
+    for r in results:
+        print(r['report'])
+        print('')
+        print('')
+    print('-- Timings --')
+    print('download: %.1f s (%d entries, %d treatments)' % (
+        fetched, len(entries), len(treatments)))
+    for r in results:
+        print('%d days: %.1f s%s' % (r['days'], r['seconds'], '' if r['ok'] else ' (failed)'))
+    print('total: %.1f s' % (time.time() - started))
+    if not all(r['ok'] for r in results):
+        return 3
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
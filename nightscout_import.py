@@ -0,0 +1,405 @@
+"""
+Import glucose, bolus, basal and carbs from CGM and pump CSV exports.
+
+Reads the export in chunks of CHUNK_ROWS rows, converts the columns of a
+chunk with numpy and builds the records with the NightscoutUploader
+builders. Parsing runs in a thread ahead of the upload, at most QUEUE
+chunks ahead, so memory stays flat for exports of any length. After each
+uploaded chunk the progress is written to a checkpoint file, an
+interrupted import continues after the last uploaded chunk.
+
+Usage: ./nightscout_import.py --format dexcom --tz Europe/Berlin export.csv
+with NIGHTSCOUT_URL and NIGHTSCOUT_SECRET set, see --help for the column
+options of other exports.
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+from datetime import datetime
+import argparse
+import calendar
+import collections
+import csv
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+import pytz
+
+import nightscout_to_json
+import nightscout_uploader
+
+
+CHUNK_ROWS = 20000
+# parsed chunks waiting for the upload
+QUEUE = 2
+# lines searched for the header row, exports start with a preamble
+HEADER_LINES = 50
+
+# Column names of known exports. time is one column or a list of columns
+# joined with a space, glucose columns in mmol/L are converted.
+FORMATS = {
+    'dexcom': {
+        'time': 'Timestamp (YYYY-MM-DDThh:mm:ss)',
+        'time_format': '%Y-%m-%dT%H:%M:%S',
+        'glucose': 'Glucose Value (mg/dL)',
+        'bolus': 'Insulin Value (u)',
+        'carbs': 'Carb Value (grams)',
+        # long acting insulin is no bolus
+        'exclude': {'Event Subtype': ['Long-Acting']},
+    },
+    'libre': {
+        'time': 'Device Timestamp',
+        'time_format': '%m-%d-%Y %H:%M',
+        'glucose': 'Historic Glucose mg/dL',
+        'bolus': 'Rapid-Acting Insulin (units)',
+        'carbs': 'Carbohydrates (grams)',
+    },
+    'carelink': {
+        'time': ['Date', 'Time'],
+        'time_format': '%Y/%m/%d %H:%M:%S',
+        'glucose': 'Sensor Glucose (mg/dL)',
+        'bolus': 'Bolus Volume Delivered (U)',
+        'basal': 'Basal Rate (U/h)',
+        'carbs': 'BWZ Carb Input (grams)',
+    },
+}
+
+KINDS = ('glucose', 'bolus', 'basal', 'carbs')
+
+# stands in for the bolus objects of pump libraries _bolus() expects
+Bolus = collections.namedtuple('Bolus', 'type volume')
+
+
+def fixed_fields(fmt):
+    """Offsets and widths of the fields of a fixed width strptime format.
+
+    Returns (fields, separators, width), or None if fmt has fields of
+    varying width.
+    """
+    widths = {'Y': 4, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
+    fields = {}
+    separators = {}
+    pos = 0
+    i = 0
+    while i < len(fmt):
+        if fmt[i] == '%':
+            field = fmt[i + 1:i + 2]
+            if field not in widths or field in fields:
+                return None
+            fields[field] = (pos, widths[field])
+            pos += widths[field]
+            i += 2
+        else:
+            separators[pos] = fmt[i]
+            pos += 1
+            i += 1
+    return fields, separators, pos
+
+
+def strptime(values, fmt):
+    """Local times of values in seconds since the epoch, None where invalid."""
+    local = []
+    for v in values:
+        try:
+            local.append(calendar.timegm(datetime.strptime(v, fmt).timetuple()))
+        except ValueError:
+            local.append(None)
+    return local
+
+
+def parse_times(values, fmt, localtime):
+    """Epochs of the local times values in format fmt, -1 where invalid.
+
+    Fixed width formats are parsed for the whole array at once, digit by
+    digit, others and values without zero padding with strptime.
+    """
+    values = np.asarray(values, dtype=str)
+    fixed = fixed_fields(fmt)
+    if fixed is None:
+        local = strptime(values.tolist(), fmt)
+        ok = np.array([t is not None for t in local], dtype=bool)
+        local = np.array([t or 0 for t in local], dtype=np.int64)
+    else:
+        fields, separators, width = fixed
+        chars = np.zeros((len(values), width), dtype=np.int64)
+        if len(values):
+            # the code points, shorter values are padded with 0
+            chars = values.astype('U%d' % width).view(np.uint32).reshape(
+                    len(values), width).astype(np.int64)
+        ok = np.char.str_len(values) == width
+        for pos, c in separators.items():
+            ok &= chars[:, pos] == ord(c)
+        digits = chars - ord('0')
+        number = {}
+        for field, (pos, n) in fields.items():
+            d = digits[:, pos:pos + n]
+            ok &= ((d >= 0) & (d <= 9)).all(axis=1)
+            number[field] = (d * 10 ** np.arange(n - 1, -1, -1)).sum(axis=1)
+        zero = np.zeros(len(values), dtype=np.int64)
+        year = number.get('Y', zero + 1970)
+        month = number.get('m', zero + 1)
+        day = number.get('d', zero + 1)
+        hour = number.get('H', zero)
+        minute = number.get('M', zero)
+        second = number.get('S', zero)
+        ok &= (month >= 1) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)
+        months = np.where(ok, (year - 1970) * 12 + month - 1, 0)
+        days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+        month_days = (months + 1).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) - days
+        ok &= (day >= 1) & (day <= month_days)
+        local = 86400 * (days + np.where(ok, day - 1, 0)) + 3600 * hour + 60 * minute + second
+        retry = np.flatnonzero(~ok & (np.char.str_len(values) > 0))
+        for i, t in zip(retry.tolist(), strptime(values[retry].tolist(), fmt)):
+            if t is not None:
+                local[i] = t
+                ok[i] = True
+    return np.where(ok, localtime.utc(local), -1)
+
+
+def parse_numbers(values):
+    """Floats of values, NaN where empty or not a number."""
+    values = np.char.replace(np.char.strip(np.asarray(values, dtype=str)), ',', '.')
+    values = np.where(values == '', 'nan', values)
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        # text like High or Low in between
+        numbers = []
+        for v in values.tolist():
+            try:
+                numbers.append(float(v))
+            except ValueError:
+                numbers.append(np.nan)
+        return np.array(numbers, dtype=np.float64)
+
+
+def open_export(path, columns):
+    """The csv reader of path positioned after the header and the header.
+
+    The header is the first of HEADER_LINES lines holding all of columns,
+    the delimiter the most frequent of comma, semicolon and tab in it.
+    """
+    f = open(path, newline='', encoding='utf-8-sig')
+    for line in itertools.islice(f, HEADER_LINES):
+        if all(c in line for c in columns):
+            delimiter = max(',;\t', key=line.count)
+            header = next(csv.reader([line], delimiter=delimiter))
+            if all(c in header for c in columns):
+                return csv.reader(f, delimiter=delimiter), header
+    f.close()
+    raise ValueError('no header with columns %s in the first %d lines of %s' % (
+            ', '.join(columns), HEADER_LINES, path))
+
+
+class Importer(object):
+    """Upload the records of one CSV export through uploader.
+
+    spec maps time, time_format, the KINDS to column names, see FORMATS.
+    Kinds without a column are not imported.
+    """
+
+    def __init__(self, uploader, path, spec, tz, checkpoint=None):
+        self.uploader = uploader
+        self.path = path
+        self.spec = spec
+        self.localtime = nightscout_to_json.LocalTime(tz)
+        self.checkpoint = checkpoint or path + '.import.json'
+        self.time_columns = spec['time'] if isinstance(spec['time'], list) else [spec['time']]
+        self.columns = [spec[k] for k in KINDS if spec.get(k)]
+        self.state = {'rows': 0, 'uploaded': {'entries': 0, 'treatments': 0},
+                      'descending': None, 'basal': None}
+
+    def load(self):
+        """Continue from the checkpoint of an earlier import of path."""
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+        except IOError:
+            return False
+        if state.get('source') != os.path.abspath(self.path):
+            return False
+        self.state.update(state)
+        return True
+
+    def save(self):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(self.state, source=os.path.abspath(self.path)), f)
+        os.replace(tmp, self.checkpoint)
+
+    def chunks(self, skip=0):
+        """Rows read so far, epochs, rows to keep and numeric columns per chunk."""
+        exclude = self.spec.get('exclude', {})
+        reader, header = open_export(self.path, self.time_columns + self.columns)
+        index = {c: header.index(c) for c in self.time_columns + self.columns + list(exclude)
+                 if c in header}
+        rows = skip
+        for _ in itertools.islice(reader, skip):
+            pass
+        while True:
+            chunk = list(itertools.islice(reader, CHUNK_ROWS))
+            if not chunk:
+                return
+            rows += len(chunk)
+
+            def column(name):
+                # rows may be shorter than the header
+                i = index[name]
+                return np.array([r[i] if i < len(r) else '' for r in chunk], dtype=str)
+
+            times = column(self.time_columns[0])
+            for c in self.time_columns[1:]:
+                times = np.char.add(np.char.add(times, ' '), column(c))
+            ts = parse_times(np.char.strip(times), self.spec['time_format'], self.localtime)
+            keep = ts >= 0
+            for c, values in exclude.items():
+                if c in index:
+                    keep &= ~np.isin(column(c), values)
+            columns = {}
+            for kind in KINDS:
+                name = self.spec.get(kind)
+                if name:
+                    columns[kind] = parse_numbers(column(name))
+            yield rows, ts, keep, columns
+
+    def records(self, ts, keep, columns):
+        """The entries and treatments of one chunk, by the uploader builders."""
+        u = self.uploader
+        if self.parsing['descending'] is None and keep.sum() > 1:
+            valid = ts[keep]
+            self.parsing['descending'] = bool(valid[-1] < valid[0])
+        descending = self.parsing['descending']
+
+        def dates(mask):
+            return [datetime.fromtimestamp(t, pytz.utc) for t in ts[mask].tolist()]
+
+        entries = []
+        treatments = []
+        if 'glucose' in columns:
+            glucose = columns['glucose']
+            mask = keep & (glucose > 0)
+            if 'mmol' in self.spec['glucose'].lower():
+                glucose = glucose * nightscout_to_json.MGDL_TO_MMOL
+            entries.extend(u._glucose(zip(dates(mask), np.round(glucose[mask]).tolist(),
+                                          itertools.repeat('mg/dL')), 'sgv'))
+        if 'bolus' in columns:
+            mask = keep & (columns['bolus'] > 0)
+            treatments.extend(u._bolus(zip(dates(mask), [
+                    Bolus('Normal', v) for v in columns['bolus'][mask].tolist()])))
+        if 'carbs' in columns:
+            mask = keep & (columns['carbs'] > 0)
+            treatments.extend(u._carbs(zip(dates(mask), columns['carbs'][mask].tolist())))
+        if 'basal' in columns:
+            mask = keep & ~np.isnan(columns['basal'])
+            rates = list(zip(dates(mask), columns['basal'][mask].tolist()))
+            if descending:
+                rates.reverse()
+            if rates:
+                # a rate lasts until the next one in time, _basal() leaves
+                # out the last one, it ends in the next chunk
+                carry = self.parsing['basal']
+                carry = [(datetime.fromtimestamp(carry[0], pytz.utc), carry[1])] if carry else []
+                following = rates[0] if descending else rates[-1]
+                rates = rates + carry if descending else carry + rates
+                treatments.extend(u._basal(iter(rates)))
+                self.parsing['basal'] = [int(following[0].timestamp()), following[1]]
+        return entries, treatments
+
+    def parse(self, out):
+        # ahead of self.state, which only counts uploaded chunks
+        self.parsing = {'descending': self.state['descending'], 'basal': self.state['basal']}
+        try:
+            for rows, ts, keep, columns in self.chunks(self.state['rows']):
+                out.put((rows, self.records(ts, keep, columns), dict(self.parsing)))
+            out.put(None)
+        except Exception as e:
+            out.put(e)
+
+    def run(self, dry_run=False):
+        """Import the rows after the checkpoint, yields the state per chunk."""
+        parsed = queue.Queue(QUEUE)
+        thread = threading.Thread(target=self.parse, args=(parsed,), daemon=True)
+        thread.start()
+        while True:
+            item = parsed.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            rows, (entries, treatments), parsing = item
+            for path, records in (('entries', entries), ('treatments', treatments)):
+                if records and not dry_run:
+                    response = self.uploader.upload(path, records)
+                    if response is not nightscout_uploader.NoData:
+                        response.close()
+                self.state['uploaded'][path] += len(records)
+            self.state.update(parsing, rows=rows)
+            if not dry_run:
+                self.save()
+            yield self.state
+        thread.join()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='CSV export to import')
+    parser.add_argument('--format', choices=sorted(FORMATS),
+                        help='column names of a known export')
+    parser.add_argument('--tz', default='UTC', help='time zone of the export times')
+    parser.add_argument('--time', nargs='+', help='time column, or date and time columns')
+    parser.add_argument('--time-format', help='strptime format of the time')
+    for kind in KINDS:
+        parser.add_argument('--' + kind, help='%s column, "" to skip' % kind)
+    parser.add_argument('--url', help='Nightscout URL, default NIGHTSCOUT_URL')
+    parser.add_argument('--secret', help='API secret, default NIGHTSCOUT_SECRET')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to wait between uploaded batches')
+    parser.add_argument('--checkpoint', help='progress file, default <path>.import.json')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint')
+    parser.add_argument('--dry-run', action='store_true', help='parse and count only')
+    args = parser.parse_args(argv)
+
+    spec = dict(FORMATS.get(args.format, {}))
+    if args.time:
+        spec['time'] = args.time if len(args.time) > 1 else args.time[0]
+    if args.time_format:
+        spec['time_format'] = args.time_format
+    for kind in KINDS:
+        if getattr(args, kind) is not None:
+            spec[kind] = getattr(args, kind)
+    if 'time' not in spec or 'time_format' not in spec:
+        parser.error('--time and --time-format are needed without --format')
+
+    url = args.url or os.environ.get('NIGHTSCOUT_URL')
+    secret = args.secret or os.environ.get('NIGHTSCOUT_SECRET')
+    if not args.dry_run and not (url and secret):
+        parser.error('--url and --secret, or NIGHTSCOUT_URL and NIGHTSCOUT_SECRET are needed')
+    # a dry run only uses the record builders
+    uploader = nightscout_uploader.NightscoutUploader(
+            url, secret or 'dry-run', device='nightscout_import_py', pause=args.pause)
+    importer = Importer(uploader, args.path, spec, args.tz, args.checkpoint)
+    if not args.restart and importer.load():
+        print('Continuing after row %d' % importer.state['rows'])
+    for state in importer.run(args.dry_run):
+        print('Rows %d, entries %d, treatments %d' % (
+            state['rows'], state['uploaded']['entries'], state['uploaded']['treatments']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
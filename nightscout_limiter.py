@@ -0,0 +1,139 @@
+"""
+Admission control for the requests to Nightscout sites.
+
+Most Nightscout sites run on small hosts which answer parallel requests
+with 503 or time out. HostLimiter allows a number of requests in flight
+per host, lets a bounded number more wait for a slot until a deadline
+and rejects the rest right away with a time to retry after.
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+import contextlib
+import math
+import threading
+import time
+
+from nightscout_to_json import DownloadError
+
+
+MAX_INFLIGHT = 2
+MAX_QUEUE = 16
+QUEUE_TIMEOUT = 20.0
+
+
+class Overloaded(DownloadError):
+    """No slot for a request to host, retry_after is in seconds."""
+
+    def __init__(self, host, message, retry_after):
+        super().__init__(503, message)
+        self.host = host
+        self.retry_after = retry_after
+
+
+class Host(object):
+    """Slots, waiting requests and counters of one host."""
+
+    def __init__(self, lock):
+        self.ready = threading.Condition(lock)
+        self.inflight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # moving average of the request time, for retry_after
+        self.call_avg = 1.0
+
+
+class HostLimiter(object):
+    """Limit the requests in flight per host.
+
+    A request gets a slot if fewer than max_inflight requests to its host
+    are in flight, else it waits in the queue of the host for at most
+    timeout seconds. With max_queue requests already waiting it is
+    rejected immediately. Both raise Overloaded.
+    """
+
+    def __init__(self, max_inflight=None, max_queue=None, timeout=None):
+        self.max_inflight = max_inflight or MAX_INFLIGHT
+        self.max_queue = MAX_QUEUE if max_queue is None else max_queue
+        self.timeout = timeout or QUEUE_TIMEOUT
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def retry_after(self, h):
+        # until the requests in flight and waiting are through
+        batches = (h.inflight + h.queued) / float(self.max_inflight)
+        return max(int(math.ceil(batches * h.call_avg)), 1)
+
+    def acquire(self, host):
+        with self.lock:
+            h = self.hosts.setdefault(host, Host(self.lock))
+            started = time.time()
+            if h.inflight >= self.max_inflight or h.queued:
+                if h.queued >= self.max_queue:
+                    h.shed += 1
+                    raise Overloaded(host, 'too many requests to %s queued' % host,
+                                     self.retry_after(h))
+                h.queued += 1
+                h.max_queued = max(h.max_queued, h.queued)
+                deadline = started + self.timeout
+                try:
+                    while h.inflight >= self.max_inflight:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            h.timed_out += 1
+                            raise Overloaded(host, 'no slot for %s within %.0f s' % (
+                                host, self.timeout), self.retry_after(h))
+                        h.ready.wait(remaining)
+                finally:
+                    h.queued -= 1
+            waited = time.time() - started
+            h.inflight += 1
+            h.admitted += 1
+            h.wait_total += waited
+            h.wait_max = max(h.wait_max, waited)
+            return h
+
+    def release(self, h, elapsed):
+        with self.lock:
+            h.inflight -= 1
+            h.call_avg = 0.8 * h.call_avg + 0.2 * elapsed
+            h.ready.notify()
+
+    @contextlib.contextmanager
+    def slot(self, host):
+        h = self.acquire(host)
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.release(h, time.time() - started)
+
+    def metrics(self):
+        """Queue depth, wait times and counters per host."""
+        with self.lock:
+            return {host: {
+                'inflight': h.inflight,
+                'queued': h.queued,
+                'max_queued': h.max_queued,
+                'admitted': h.admitted,
+                'shed': h.shed,
+                'timed_out': h.timed_out,
+                'wait_avg_ms': round(1000 * h.wait_total / max(h.admitted, 1), 1),
+                'wait_max_ms': round(1000 * h.wait_max, 1),
+                'request_avg_ms': round(1000 * h.call_avg, 1),
+            } for host, h in self.hosts.items()}
@@ -0,0 +1,295 @@
+"""
+Keep a converted Nightscout timeline current with pushed records.
+
+Entries and treatments posted like to the Nightscout API v1 are applied
+to the buckets of a timeline from nightscout_to_json.convert(), which is
+extended when they are newer than its end. Only the buckets a record
+touches change, and only the stats() sums of those buckets are updated.
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+import bisect
+import threading
+import time
+
+import numpy as np
+
+import nightscout_to_json
+from nightscout_to_json import TREATMENT_KEYS, parse_ts
+
+# records further in the future are rejected instead of extending the
+# timeline up to them
+MAX_AHEAD = 3600
+
+# longest temp basal, in seconds
+MAX_TEMP = 86400
+
+AGE_EVENTS = {
+    'Insulin Change': 'iage',
+    'Site Change': 'cage',
+    'Sensor Change': 'sage',
+    'Sensor Start': 'sage',
+}
+
+
+def timestamp(doc, collection):
+    """Epoch of an entry (dateString or date in ms) or a treatment."""
+    if collection == 'entries':
+        return parse_ts(doc['dateString']) if 'dateString' in doc else int(doc['date']) // 1000
+    return parse_ts(doc['created_at'])
+
+
+def copy_timeline(new):
+    """Copy of new with its own lists, which can change while new is read."""
+    copy = {k: list(v) if isinstance(v, list) else v for k, v in new.items()}
+    copy['carbs'] = {a: list(x) for a, x in new['carbs'].items()}
+    return copy
+
+
+class LiveTimeline(object):
+    """The timeline new of convert() and the sums of stats() for it.
+
+    entries and treatments are the documents new was converted from,
+    they are needed for the glucose around and the temp basal running at
+    the buckets pushed records change.
+
+    push() changes a copy of new. Readers take snapshot, the timeline
+    and its stats() as of the last push, which is never changed.
+    """
+
+    def __init__(self, new, profile, entries, treatments, max_gap=None):
+        self.new = new
+        self.lock = threading.Lock()
+        self.max_gap = max_gap or nightscout_to_json.MAX_GAP
+        self.size = new['size']
+        self.min_ts = new['timeline'][0]
+        self.localtime = nightscout_to_json.LocalTime(new['tz'], self.min_ts)
+        ts, sgv = nightscout_to_json.ingest_entries(entries, [])
+        self.entry_ts = ts.tolist()
+        self.entry_sgv = sgv.tolist()
+        treatment_ts, treatments = nightscout_to_json.ingest_treatments(treatments, [])
+        self.seen = set(self.key(t) for t in treatments)
+        self.profiles = nightscout_to_json.ProfileTimeline(profile, [
+                t for t in treatments if t.get('eventType') == 'Profile Switch'])
+        # temp basals as (start, rate, duration), in time order
+        self.temps = [(ts, t['rate'], t['duration'] * 60)
+                      for ts, t in zip(treatment_ts, treatments)
+                      if t['eventType'] == 'Temp Basal']
+        self.temp_starts = [t[0] for t in self.temps]
+        self.aggregates = nightscout_to_json.Aggregates(new)
+        self.snapshot = (new, self.stats())
+
+    @staticmethod
+    def key(t):
+        return (t['created_at'],) + tuple(t.get(k) for k in TREATMENT_KEYS)
+
+    def bucket(self, ts):
+        return (ts - self.min_ts) // self.size
+
+    def stats(self):
+        return self.aggregates.format()
+
+    def extend(self, ts):
+        """Append buckets up to the one of ts, with schedules and no events."""
+        new = self.new
+        first = len(new['timeline'])
+        last = self.bucket(ts) + 1
+        if last <= first:
+            return
+        timeline = self.min_ts + self.size * np.arange(first, last, dtype=np.int64)
+        hours = self.localtime.hours(timeline)
+        seconds = self.localtime.seconds(timeline)
+        basal_rate = self.profiles.lookup(timeline, seconds, 'basal')
+        prog_basal = basal_rate * self.size / 3600
+        n = last - first
+        # glucose stays at the last entry until the next one arrives
+        glucose = np.interp(timeline, self.entry_ts[-1:] or [0], self.entry_sgv[-1:] or [0])
+        new['timeline'].extend(timeline.tolist())
+        new['hours'].extend(hours.tolist())
+        new['glucose'].extend(glucose.tolist())
+        new['valid'].extend([False] * n)
+        new['basal_rate'].extend(basal_rate.tolist())
+        new['isf_schedule'].extend(self.profiles.lookup(timeline, seconds, 'sens').tolist())
+        new['carb_ratio_schedule'].extend(
+                self.profiles.lookup(timeline, seconds, 'carbratio').tolist())
+        new['prog_basal'].extend(prog_basal.tolist())
+        new['bolus'].extend([0.0] * n)
+        new['basal'].extend([0.0] * n)
+        new['insulin'].extend(prog_basal.tolist())
+        for x in new['carbs'].values():
+            x.extend([0.0] * n)
+        for key in ('iage', 'cage', 'sage'):
+            age = new[key][-1] if new[key] else -1
+            if age >= 0:
+                new[key].extend((age + self.size * np.arange(1, n + 1)).astype(np.float64).tolist())
+            else:
+                new[key].extend([-1.0] * n)
+        for i in range(first, last):
+            self.aggregates.append(i)
+        # running temp basals continue into the new buckets
+        start = self.min_ts + first * self.size
+        for j in range(len(self.temps) - 1, -1, -1):
+            ts, rate, duration = self.temps[j]
+            if ts < start - MAX_TEMP:
+                break
+            if duration:
+                self.apply_temp(ts, rate, self.duration(j), first=first)
+
+    def change(self, i, **values):
+        """Set columns of bucket i and update its sums."""
+        new = self.new
+        old = self.aggregates.point(i)
+        for k, v in values.items():
+            new[k][i] = v
+        self.aggregates.replace(i, old)
+
+    def duration(self, j):
+        """Duration of temp basal j as convert() applies it.
+
+        A later temp basal ends it if it was still running, a cancel (a
+        temp basal of duration 0) always sets its end.
+        """
+        ts, rate, duration = self.temps[j]
+        active_until = ts + duration
+        for later, _, d in self.temps[j + 1:]:
+            if d == 0:
+                duration = later - ts
+                active_until = None
+                continue
+            if active_until is not None and active_until >= later:
+                duration = later - ts
+            break
+        return duration
+
+    def add_temp(self, ts, rate, duration):
+        j = bisect.bisect_right(self.temp_starts, ts)
+        # the temp basal before may end earlier now
+        before = j - 1
+        while before >= 0 and not self.temps[before][2]:
+            before -= 1
+        old = self.duration(before) if before >= 0 else None
+        self.temps.insert(j, (ts, rate, duration))
+        self.temp_starts.insert(j, ts)
+        if before >= 0 and self.duration(before) != old:
+            start, before_rate, _ = self.temps[before]
+            self.apply_temp(start, before_rate, old, sign=-1)
+            self.apply_temp(start, before_rate, self.duration(before))
+        if duration:
+            self.apply_temp(ts, rate, self.duration(j))
+
+    def apply_temp(self, ts, rate, duration, sign=1, first=0):
+        """Add (or with sign -1 remove) a temp basal from buckets first on.
+
+        Covers the buckets like convert(), from the start of the bucket of
+        ts on in bucket size steps.
+        """
+        new = self.new
+        nbuckets = len(new['timeline'])
+        bucket = self.bucket(ts)
+        i = 0
+        while duration > 0:
+            b = bucket + i
+            covered = min(self.size, duration)
+            if b >= nbuckets:
+                break
+            if b >= first and b >= 0:
+                delta = sign * (rate / 3600 * covered - new['basal_rate'][b] / 3600 * covered)
+                self.change(b, basal=new['basal'][b] + delta,
+                            insulin=new['insulin'][b] + delta)
+            duration -= self.size
+            i += 1
+
+    def add_entry(self, e):
+        if 'sgv' not in e:
+            return False
+        ts = timestamp(e, 'entries')
+        i = bisect.bisect_left(self.entry_ts, ts)
+        if i < len(self.entry_ts) and self.entry_ts[i] == ts:
+            return False
+        self.extend(ts)
+        self.entry_ts.insert(i, ts)
+        self.entry_sgv.insert(i, e['sgv'])
+
+        # the buckets between the neighbouring entries are interpolated
+        # from this one now
+        new = self.new
+        nbuckets = len(new['timeline'])
+        lo = max(i - 1, 0)
+        hi = min(i + 2, len(self.entry_ts))
+        first = 0 if i == 0 else max(-(-(self.entry_ts[i - 1] - self.min_ts) // self.size), 0)
+        last = nbuckets if i + 1 == len(self.entry_ts) else min(
+                self.bucket(self.entry_ts[i + 1]) + 1, nbuckets)
+        timeline = np.asarray(new['timeline'][first:last])
+        index = self.entry_ts[lo:hi]
+        glucose = np.interp(timeline, index, self.entry_sgv[lo:hi]).tolist()
+        valid = nightscout_to_json.valid_buckets(timeline, index, self.max_gap).tolist()
+        for b, g, v in zip(range(first, last), glucose, valid):
+            if new['glucose'][b] != g or new['valid'][b] != v:
+                self.change(b, glucose=g, valid=v)
+        return True
+
+    def add_treatment(self, t):
+        key = self.key(t)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        ts = parse_ts(t['created_at'])
+        self.extend(ts)
+        new = self.new
+        b = self.bucket(ts)
+        if b < 0:
+            return False
+        event = t.get('eventType', '')
+        if event == 'Temp Basal':
+            self.add_temp(ts, t.get('rate', 0), t['duration'] * 60)
+        elif event in ('Bolus', 'Correction Bolus'):
+            self.change(b, bolus=new['bolus'][b] + t['insulin'],
+                        insulin=new['insulin'][b] + t['insulin'])
+        elif event in ('Meal Bolus', 'Carb Correction'):
+            absorption = t.get('absorptionTime', 180)
+            if absorption not in new['carbs']:
+                new['carbs'][absorption] = [0.0] * len(new['timeline'])
+            old = self.aggregates.point(b)
+            new['carbs'][absorption][b] += t['carbs']
+            self.aggregates.replace(b, old)
+        elif event in AGE_EVENTS:
+            # like convert(), ages count from the first change on
+            column = new[AGE_EVENTS[event]]
+            if column[-1] < 0:
+                for i in range(b, len(column)):
+                    column[i] = float((i - b) * self.size)
+        else:
+            return False
+        return True
+
+    def push(self, collection, docs, now=None):
+        """Apply entries or treatments docs, returns how many changed new.
+
+        Publishes the changed copy of new and its stats() as snapshot.
+        """
+        limit = (now or time.time()) + MAX_AHEAD
+        add = self.add_entry if collection == 'entries' else self.add_treatment
+        changed = 0
+        with self.lock:
+            self.new = self.aggregates.new = copy_timeline(self.new)
+            try:
+                for doc in docs:
+                    ts = timestamp(doc, collection)
+                    if ts < self.min_ts or ts > limit:
+                        continue
+                    changed += add(doc)
+            finally:
+                # also after a malformed doc, the ones before it are applied
+                self.snapshot = (self.new, self.stats())
+        return changed
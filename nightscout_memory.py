@@ -0,0 +1,160 @@
+"""
+Memory profile of the conversion pipeline behind /<url>/all.json.
+
+Serves a synthetic Nightscout site from a separate process and runs
+download, convert, stats, the streamed all.json of the service and the
+same as one json.dumps() against it, each stage between tracemalloc
+snapshots. Reports the peak
+and the retained (still allocated after the stage) bytes per stage and
+checks them against the budgets for the dataset size.
+
+Usage: ./nightscout_memory.py [--days 7 30 90] [--top 5]
+exits with 1 when a stage exceeds its budget.
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+import tracemalloc
+
+# nightscout_to_json imports it on the first download, the download
+# stage should only count the data
+import requests
+
+import nightscout_stats_service
+import nightscout_synthetic
+import nightscout_to_json
+
+
+STAGES = ('download', 'convert', 'stats', 'serialize', 'dumps')
+
+# peak MB per stage and dataset size in days, about 1.5 times the
+# measured values so only real regressions fail
+BUDGETS = {
+    7: {'download': 4, 'convert': 5, 'stats': 1, 'serialize': 1, 'dumps': 5},
+    30: {'download': 12, 'convert': 12, 'stats': 1, 'serialize': 1, 'dumps': 20},
+    90: {'download': 32, 'convert': 35, 'stats': 3, 'serialize': 1, 'dumps': 56},
+}
+
+def serve_site(days, port):
+    # runs in its own process, so the server allocations are not traced
+    import nightscout_autotune
+    server = nightscout_autotune.serve(*nightscout_synthetic.synthetic_site(days))
+    port.put(server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+
+def measure(stages, top=0):
+    """Run the (name, function) stages in order, each on the previous result.
+
+    Returns a dict of stage name to peak and retained bytes, relative to
+    the memory allocated before the stage.
+    """
+    report = {}
+    value = None
+    tracemalloc.start()
+    try:
+        for name, f in stages:
+            snapshot = tracemalloc.take_snapshot() if top else None
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            value = f(value)
+            current, peak = tracemalloc.get_traced_memory()
+            report[name] = {'peak': peak - before, 'retained': current - before}
+            if top:
+                stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+                report[name]['top'] = [str(s) for s in stats[:top]]
+    finally:
+        tracemalloc.stop()
+    return report
+
+
+def profile_pipeline(days, top=0):
+    """Memory report of one all.json request for a synthetic site of days."""
+    port = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_site, args=(days, port), daemon=True)
+    server.start()
+    try:
+        url = 'http://127.0.0.1:%d' % port.get(timeout=60)
+        dl = nightscout_to_json.Nightscout(url)
+        keep = {}
+
+        def download(_):
+            keep['raw'] = nightscout_to_json.fetch(dl, url, days, cache=False)
+            return keep['raw']
+
+        def convert(raw):
+            keep['converted'] = dl.convert(*raw)
+            return keep['converted']
+
+        def stats(converted):
+            keep['data'] = nightscout_to_json.stats(converted[1])
+            return keep['data']
+
+        def serialize(data):
+            # streamed like the all.json route of the service
+            return sum(len(piece) for piece in
+                       nightscout_stats_service.iter_all(data, keep['converted'][1]))
+
+        def dumps(size):
+            # in one piece, like the files of nightscout_to_json
+            return len(json.dumps(dict(keep['data'], all=keep['converted'][1]), indent=4))
+
+        return measure([(name, f) for name, f in zip(
+                STAGES, (download, convert, stats, serialize, dumps))], top)
+    finally:
+        server.terminate()
+
+
+def check(days, report, budgets=None):
+    """Return the stages of report over their budget for days."""
+    budgets = (budgets or BUDGETS).get(days)
+    if not budgets:
+        return []
+    return [stage for stage, limit in budgets.items()
+            if report[stage]['peak'] > limit * 2 ** 20]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, nargs='+', default=sorted(BUDGETS),
+                        help='synthetic dataset sizes to profile')
+    parser.add_argument('--top', type=int, default=0,
+                        help='show the lines allocating most per stage')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for days in args.days:
+        report = profile_pipeline(days, args.top)
+        over = check(days, report)
+        print('-- %d days --' % days)
+        for stage in STAGES:
+            r = report[stage]
+            limit = BUDGETS.get(days, {}).get(stage)
+            print('%-10s peak %7.1f MB  retained %7.1f MB  budget %s%s' % (
+                stage, r['peak'] / 2 ** 20, r['retained'] / 2 ** 20,
+                '%d MB' % limit if limit else '-',
+                '  OVER BUDGET' if stage in over else ''))
+            for line in r.get('top', []):
+                print('    ' + line)
+        failed = failed or bool(over)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
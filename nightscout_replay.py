@@ -0,0 +1,219 @@
+"""
+Record and replay the HTTP exchanges of a Nightscout client.
+
+An archive is a gzip file with one JSON object per exchange: path
+relative to the site url, parameters, status code, elapsed time and
+response body. Recording appends to it, replaying serves the recorded
+responses without network, optionally with the recorded latency.
+Secrets in request paths and the token of authorization responses are
+recorded as <secret>.
+
+Usage: ./nightscout_replay.py archive.jsonl.gz [--port 8080] [--latency]
+serves the archives as a stub Nightscout site.
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+import argparse
+import collections
+import gzip
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+
+
+# responses carrying credentials by path prefix, and the key of those
+CREDENTIALS = (
+    ('/api/v2/authorization/request/', 'token'),
+)
+
+
+def is_time_param(k):
+    """True for parameters selecting a time range, e.g. find[date][$gte]."""
+    return bool(re.search(r'\$(gte|gt|lte|lt)\]?$', k))
+
+
+def request_key(path, params, exact=True):
+    """Key to match a request to recorded exchanges.
+
+    The inexact key ignores time ranges, so an archive also replays when
+    the requested range moved, e.g. on another day.
+    """
+    items = sorted((str(k), str(v)) for k, v in (params or {}).items()
+                   if exact or not is_time_param(k))
+    if not exact:
+        path = re.sub(r'/\d+(?=/|$)', '/<n>', path)
+    return path, tuple(items)
+
+
+class ReplayResponse(object):
+    """The part of requests.Response the clients use."""
+
+    def __init__(self, exchange):
+        self.status_code = exchange['status']
+        self.text = exchange['body']
+        self.elapsed = exchange['elapsed']
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Archive(object):
+    """HTTP exchanges of one Nightscout site, mode is record or replay.
+
+    In replay mode requests are matched on path and parameters first, then
+    ignoring time ranges. Repeated matches are served in recorded order,
+    the last exchange repeats once all were served.
+    """
+
+    def __init__(self, fn, mode='replay', latency=False, secrets=()):
+        self.fn = fn
+        self.mode = mode
+        self.latency = latency
+        self.secrets = [s for s in secrets if s]
+        self.lock = threading.Lock()
+        # appends of concurrent saves would interleave in the gzip file
+        self.save_lock = threading.Lock()
+        self.pending = []
+        self.exchanges = {}
+        self.served = collections.Counter()
+        if mode == 'replay':
+            self.load(fn)
+        elif mode != 'record':
+            raise ValueError('unknown archive mode %s' % mode)
+
+    def load(self, fn):
+        with gzip.open(fn, 'rt') as f:
+            for line in f:
+                self.add(json.loads(line))
+
+    def add(self, exchange):
+        params = dict(exchange['params'])
+        for exact in (True, False):
+            key = request_key(exchange['path'], params, exact)
+            self.exchanges.setdefault(key, []).append(exchange)
+
+    def redact(self, path):
+        for s in self.secrets:
+            path = path.replace(s, '<secret>')
+        return path
+
+    def redact_body(self, path, text):
+        """The response text of path without the credentials it carries."""
+        for prefix, key in CREDENTIALS:
+            if not path.startswith(prefix):
+                continue
+            try:
+                j = json.loads(text)
+            except ValueError:
+                return text
+            if isinstance(j, dict) and key in j:
+                j[key] = '<secret>'
+                return json.dumps(j)
+        return text
+
+    def lookup(self, path, params):
+        for exact in (True, False):
+            key = request_key(path, params, exact)
+            if key in self.exchanges:
+                with self.lock:
+                    exchanges = self.exchanges[key]
+                    exchange = exchanges[min(self.served[key], len(exchanges) - 1)]
+                    self.served[key] += 1
+                return exchange
+        return None
+
+    def get(self, base, url, params=None, headers=None):
+        """Drop-in for requests.get() of the client for site base."""
+        path = self.redact(url[len(base):] if url.startswith(base) else url)
+        params = params or {}
+        if self.mode == 'replay':
+            exchange = self.lookup(path, params)
+            if exchange is None:
+                exchange = {'status': 404, 'elapsed': 0.0,
+                            'body': 'not recorded: %s' % path}
+            if self.latency:
+                time.sleep(exchange['elapsed'])
+            return ReplayResponse(exchange)
+
+        started = time.time()
+        response = requests.get(url, params=params, headers=headers)
+        with self.lock:
+            self.pending.append({
+                'path': path,
+                'params': sorted([str(k), str(v)] for k, v in params.items()),
+                'status': response.status_code,
+                'elapsed': round(time.time() - started, 3),
+                'body': self.redact_body(path, response.text),
+            })
+        return response
+
+    def save(self):
+        """Append the exchanges recorded since the last save."""
+        with self.save_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            # gzip members can be concatenated, so appending is fine
+            with gzip.open(self.fn, 'at') as f:
+                for exchange in pending:
+                    f.write(json.dumps(exchange, separators=(',', ':')) + '\n')
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        exchange = self.server.archive.lookup(url.path, params)
+        if exchange is None:
+            exchange = {'status': 404, 'elapsed': 0.0,
+                        'body': 'not recorded: %s' % url.path}
+        if self.server.archive.latency:
+            time.sleep(exchange['elapsed'])
+        body = exchange['body'].encode('utf-8')
+        self.send_response(exchange['status'])
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(fns, port=0, latency=False):
+    """Serve the archives as a Nightscout site, returns the server."""
+    archive = Archive(fns[0], 'replay', latency=latency)
+    for fn in fns[1:]:
+        archive.load(fn)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.archive = archive
+    return server
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("archive", type=str, nargs='+', help="recorded archives")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--latency", action="store_true",
+                      help="delay responses by the recorded time")
+  args = parser.parse_args()
+
+  server = serve(args.archive, args.port, args.latency)
+  print('Serving', ', '.join(args.archive), 'on http://127.0.0.1:%d' % args.port)
+  server.serve_forever()
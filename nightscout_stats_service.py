@@ -1,4 +1,7 @@
+from flask import Blueprint
 from flask import Flask
+from flask import abort
+from flask import current_app
 from flask import render_template
 from flask import request
 from flask import url_for
@@ -29,25 +32,64 @@ formatter = RequestFormatter(
     #'%(levelname)s in %(module)s: %(message)s'
 )
 default_handler.setFormatter(formatter)
-root = logging.getLogger()
-root.addHandler(default_handler)
 
 
+import collections
+import io
 import json
 import os
 import re
 import datetime
+import hashlib
+import hmac
 import html
-
+import itertools
+import pytz
+import subprocess
+import sys
+import threading
+import time
+
+import nightscout_limiter
+import nightscout_live
+import nightscout_synthetic
 import nightscout_to_json
+import nightscout_variability
 
 
 DEBUG = (os.getenv('FLASK_ENV', 'development') == 'development')
 CACHE = {}
-
-
-app = Flask(__name__)
-app.logger.addHandler(default_handler)
+# Nightscout clients per site and credentials, API v3 clients only sync
+# changes on reuse. The least recently used beyond MAX_CLIENTS and those
+# unused for CLIENT_TTL seconds are dropped.
+CLIENTS = collections.OrderedDict()
+CLIENTS_LOCK = threading.Lock()
+MAX_CLIENTS = int(os.getenv('MAX_CLIENTS', 32))
+CLIENT_TTL = 3600
+MAX_DAYS = 365
+NIGHTSCOUT_API = os.getenv('NIGHTSCOUT_API', 'auto')
+# directories to record upstream requests to, or replay them from, with
+# one archive per file shared by all clients of the site
+RECORD_DIR = os.getenv('NIGHTSCOUT_RECORD', None)
+REPLAY_DIR = os.getenv('NIGHTSCOUT_REPLAY', None)
+ARCHIVES = {}
+# list elements per piece of streamed responses
+STREAM_ROWS = 2048
+# API secret for pushing entries and treatments, push is off without
+PUSH_SECRET = os.getenv('PUSH_SECRET', None)
+# requests in flight and waiting per Nightscout host, seconds to wait
+LIMITER = nightscout_limiter.HostLimiter(
+        int(os.getenv('UPSTREAM_MAX_INFLIGHT', nightscout_limiter.MAX_INFLIGHT)),
+        int(os.getenv('UPSTREAM_MAX_QUEUE', nightscout_limiter.MAX_QUEUE)),
+        float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', nightscout_limiter.QUEUE_TIMEOUT)))
+# run a synthetic request cycle before reporting ready, unless 0
+WARMUP = os.getenv('WARMUP', '1') != '0'
+WARMUP_DAYS = 2
+# further time zones to load during the warm-up, comma separated
+WARMUP_TIMEZONES = [z for z in os.getenv('WARMUP_TIMEZONES', '').split(',') if z]
+
+
+bp = Blueprint('service', __name__)
 
 
 class InvalidAPIUsage(Exception):
@@ -59,31 +101,76 @@ class InvalidAPIUsage(Exception):
                         self.payload = payload
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def invalid_api_usage(e):
         return '<p>' + str(e) + '</p>', 500
 
 
-@app.errorhandler(InvalidAPIUsage)
+@bp.app_errorhandler(InvalidAPIUsage)
 def invalid_api_usage_exception(e):
+        headers = {}
+        if e.payload and 'retry_after' in e.payload:
+            headers['Retry-After'] = str(e.payload['retry_after'])
         return render_template('error.html',
                                message=e.message,
                                status_code=e.status_code,
                                request_url=html.escape(request.url)
-                              ), e.status_code
+                              ), e.status_code, headers
 
 
-@app.route("/")
+@bp.route("/")
 def index():
     p = {
-        'stats_url': url_for('stats', url='URL'),
-        'all_url': url_for('all_data', url='URL')
+        'stats_url': url_for('.stats', url='URL'),
+        'all_url': url_for('.all_data', url='URL')
     }
     return render_template('index.html', **p)
 
 
 
-def get_data(url, request):
+def get_archive(url):
+    if not RECORD_DIR and not REPLAY_DIR:
+        return None
+    import nightscout_replay
+    host = url.replace('https://', '')
+    mode = 'record' if RECORD_DIR else 'replay'
+    fn = os.path.join(RECORD_DIR or REPLAY_DIR, host + '.jsonl.gz')
+    with CLIENTS_LOCK:
+        if fn not in ARCHIVES:
+            ARCHIVES[fn] = nightscout_replay.Archive(fn, mode)
+        return ARCHIVES[fn]
+
+
+def get_client(url, token, api_secret):
+    """The cached client of url and the credentials, or a new one."""
+    key = (url, token, api_secret)
+    now = time.time()
+    with CLIENTS_LOCK:
+        while CLIENTS and now - next(iter(CLIENTS.values()))[0] > CLIENT_TTL:
+            CLIENTS.popitem(last=False)
+        if key in CLIENTS:
+            client = CLIENTS[key][1]
+            CLIENTS[key] = (now, client)
+            CLIENTS.move_to_end(key)
+            return client
+        # other tokens for the site tell the API version already
+        known = [c for (u, t, _), (_, c) in CLIENTS.items() if u == url and t]
+    api = NIGHTSCOUT_API
+    if known and api == 'auto' and token:
+        v3 = isinstance(known[0], nightscout_to_json.NightscoutV3) and not known[0].v1
+        api = 'v3' if v3 else 'v1'
+    client = nightscout_to_json.connect(
+            url, api, token=token, hashed_secret=api_secret,
+            archive=get_archive(url), limiter=LIMITER)
+    with CLIENTS_LOCK:
+        # another request may have connected meanwhile
+        client = CLIENTS.setdefault(key, (now, client))[1]
+        while len(CLIENTS) > MAX_CLIENTS:
+            CLIENTS.popitem(last=False)
+    return client
+
+
+def get_data(url, request, resolution=None):
     start = request.args.get('start', None)
     end = request.args.get('end', None)
     token = request.args.get('token', None)
@@ -93,34 +180,60 @@ def get_data(url, request):
     except ValueError:
         raise InvalidAPIUsage('days needs to be a positive integer.')
     raw = bool(request.args.get('raw', False))
+    try:
+        max_gap = int(request.args.get('max_gap', nightscout_to_json.MAX_GAP // 60))
+    except ValueError:
+        raise InvalidAPIUsage('max_gap needs to be a positive integer.')
+    if max_gap < 1:
+        raise InvalidAPIUsage('max_gap needs to be a positive integer.')
 
-    if not days or days < 1 or days > 90:
-        raise InvalidAPIUsage('days need to be positive and smaller than 90.')
+    if not days or days < 1 or days > MAX_DAYS:
+        raise InvalidAPIUsage('days need to be positive and smaller than %d.' % MAX_DAYS)
+
+    if resolution and resolution not in nightscout_to_json.RESOLUTIONS:
+        raise InvalidAPIUsage('resolution needs to be one of %s.' %
+                              ', '.join(nightscout_to_json.RESOLUTIONS), 400)
 
     url = url.lower()
     if not re.match(r'^[0-9a-z\-.]+$', url):
         raise InvalidAPIUsage('URL malformed, no http or https needed, https:// is preprepended automatically.')
 
-    cache_key = (url, start, end, days, raw)
+    cache_key = (url, start, end, days, raw, max_gap)
     cache_contents = CACHE.get(cache_key, None)
     data = None
     if cache_contents:
         data = cache_contents['data']
         new = cache_contents['raw']
+        levels = cache_contents['levels']
         delta = datetime.datetime.now() - cache_contents['date']
         if delta > datetime.timedelta(hours=1):
             logging.info('Cache too old: %s', delta)
             data = None
         else:
             logging.info('Using cached content from %s', cache_contents['date'])
-            data['cached'] = True
+            # the cached dict is shared with other requests
+            data = dict(data, cached=True)
 
     if not data:
         url = 'https://' + url
         resp = ""
         try:
-            ret, new, log = nightscout_to_json.run(url, start=start, end=end, days=days, cache=False,
-                                                   token=token, hashed_secret=api_secret)
+            client = get_client(url, token, api_secret)
+            try:
+                startdate, enddate, profile, entries, treatments, tz = nightscout_to_json.fetch(
+                        client, url, days, cache=False)
+                ret, new, log = client.convert(startdate, enddate, profile, entries, treatments, tz,
+                                               max_gap=max_gap * 60)
+                # kept current by pushed entries and treatments
+                live = nightscout_live.LiveTimeline(new, profile, entries, treatments,
+                                                    max_gap=max_gap * 60)
+            finally:
+                if RECORD_DIR:
+                    client.archive.save()
+        except nightscout_limiter.Overloaded as e:
+            logging.warning('Shedding request to busy upstream %s: %s' % (url, e.args[1]))
+            raise InvalidAPIUsage('Nightscout instance is busy, retry in %d s.' % e.retry_after,
+                                  503, payload={'retry_after': e.retry_after})
         except nightscout_to_json.DownloadError as e:
             logging.warning('Failed to contact upstream %s: %s' % (url, str(e)))
             raise InvalidAPIUsage('failed to get data from Nightscout instance: ' + e.args[1], 504)
@@ -133,28 +246,99 @@ def get_data(url, request):
                 raise InvalidAPIUsage('failed to process data from Nightscount instance.', 504)
         for l in log:
             logging.info('  Debug: ', l)
-        data = nightscout_to_json.stats(new)
-        data['url'] = url
-        data['generated'] = datetime.datetime.now().isoformat()
-        CACHE[cache_key] = {'date': datetime.datetime.now(), 'data': data, 'raw': new}
-
+        data = dict(live.snapshot[1], url=url,
+                    generated=datetime.datetime.now().isoformat())
+        levels = nightscout_to_json.pyramid(new)
+        cache_contents = {'date': datetime.datetime.now(), 'data': data, 'raw': new,
+                          'levels': levels, 'live': live}
+        CACHE[cache_key] = cache_contents
+
+    if resolution:
+        if levels is None:
+            # dropped by a push
+            levels = cache_contents['levels'] = nightscout_to_json.pyramid(new)
+        new = levels[resolution]
     return data, new
 
 
-@app.route("/<url>/stats.json")
+@bp.route("/metrics.json")
+def metrics():
+    return current_app.response_class(
+        response=json.dumps({'upstream': LIMITER.metrics()}, indent=4),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@bp.route("/ready")
+def ready():
+    """200 once the warm-up of create_app() is done, 503 before."""
+    seconds = current_app.config['WARMUP_SECONDS']
+    return current_app.response_class(
+        response=json.dumps({'ready': seconds is not None, 'warmup_seconds': seconds}),
+        status=503 if seconds is None else 200,
+        mimetype='application/json'
+    )
+
+
+@bp.route("/<url>/api/v1/<any(entries, treatments):collection>", methods=['POST'])
+@bp.route("/<url>/api/v1/<any(entries, treatments):collection>.json", methods=['POST'])
+def push(url, collection):
+    """Apply entries or treatments posted like to Nightscout to the cached data."""
+    if not PUSH_SECRET:
+        raise InvalidAPIUsage('push is disabled, set PUSH_SECRET.', 403)
+    hashed = hashlib.sha1(PUSH_SECRET.encode('utf-8')).hexdigest()
+    if not hmac.compare_digest(request.headers.get('api-secret', ''), hashed):
+        raise InvalidAPIUsage('api-secret header missing or wrong.', 401)
+    docs = request.get_json(silent=True)
+    if isinstance(docs, dict):
+        docs = [docs]
+    if not isinstance(docs, list) or not all(isinstance(d, dict) for d in docs):
+        raise InvalidAPIUsage('expected a JSON document or a list of them.', 400)
+    url = url.lower()
+
+    changed = 0
+    caches = 0
+    for key, contents in list(CACHE.items()):
+        if key[0] != url or 'live' not in contents:
+            continue
+        try:
+            n = contents['live'].push(collection, docs)
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidAPIUsage('malformed %s: %s' % (collection, e), 400)
+        if n:
+            live = contents['live']
+            # readers hold on to the entry they got, it is replaced
+            # instead of changed, in the order of the pushes
+            with live.lock:
+                new, data = live.snapshot
+                CACHE[key] = dict(contents, raw=new, levels=None, data=dict(
+                        data, url=contents['data']['url'],
+                        generated=contents['data']['generated'],
+                        pushed=datetime.datetime.now().isoformat()))
+        changed += n
+        caches += 1
+    return current_app.response_class(
+        response=json.dumps({'received': len(docs), 'changed': changed, 'caches': caches}),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@bp.route("/<url>/stats.json")
 def stats(url):
     ret = get_data(url, request)
     if type(ret) == str:
         return ret
     data, new = ret
-    return app.response_class(
+    return current_app.response_class(
         response=json.dumps(data, indent=4),
         status=200,
         mimetype='application/json'
     )
 
 
-@app.route("/<url>/marc.json")
+@bp.route("/<url>/marc.json")
 def marc(url):
     ret = get_data(url, request)
     if type(ret) == str:
@@ -168,14 +352,69 @@ def marc(url):
         'url': data['url'],
         'generated': data['generated']
     }
-    return app.response_class(
+    return current_app.response_class(
         response=json.dumps(data, indent=4),
         status=200,
         mimetype='application/json'
     )
 
 
-@app.route("/<url>/<part>.csv")
+@bp.route("/<url>/rolling.json")
+def rolling(url):
+    try:
+        windows = [int(w) for w in request.args.get('windows', '7,14,30').split(',')]
+    except ValueError:
+        raise InvalidAPIUsage('windows needs to be a comma separated list of days.', 400)
+    if not windows or min(windows) < 1 or max(windows) > MAX_DAYS:
+        raise InvalidAPIUsage('windows need to be between 1 and %d days.' % MAX_DAYS, 400)
+    data, new = get_data(url, request)
+    j = nightscout_to_json.rolling(new, windows)
+    j['url'] = data['url']
+    j['generated'] = data['generated']
+    return current_app.response_class(
+        response=json.dumps(j, indent=4),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@bp.route("/<url>/variability.json")
+def variability(url):
+    data, new = get_data(url, request)
+    j = nightscout_variability.variability(new)
+    j['url'] = data['url']
+    j['generated'] = data['generated']
+    return current_app.response_class(
+        response=json.dumps(j, indent=4),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@bp.route("/<url>/agp.json")
+def agp(url):
+    message = 'bin needs to be a positive number of minutes dividing a day.'
+    try:
+        minutes = int(request.args.get('bin', 15))
+    except ValueError:
+        raise InvalidAPIUsage(message, 400)
+    if minutes < 1:
+        raise InvalidAPIUsage(message, 400)
+    data, new = get_data(url, request)
+    try:
+        j = nightscout_to_json.agp(new, minutes * 60)
+    except ValueError:
+        raise InvalidAPIUsage(message, 400)
+    j['url'] = data['url']
+    j['generated'] = data['generated']
+    return current_app.response_class(
+        response=json.dumps(j, indent=4),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@bp.route("/<url>/<part>.csv")
 def daily_csv(url, part):
     ret = get_data(url, request)
     if type(ret) == str:
@@ -184,10 +423,11 @@ def daily_csv(url, part):
     s = []
     if part == 'daily_average':
         for k, v in data['overall']['daily_average'].items():
-            s.append('"%s",%.1f' % (k, v))
+            # no value without glucose samples
+            s.append('"%s",' % k if v is None else '"%s",%.1f' % (k, v))
     else:
         abort(404)
-    return app.response_class(
+    return current_app.response_class(
         response='\n'.join(s),
         status=200,
         mimetype='text/plain'
@@ -196,19 +436,241 @@ def daily_csv(url, part):
 
 
 
-@app.route("/<url>/all.json")
+def json_key(k):
+    # json.dumps() turns int, float, bool and None keys into strings too
+    return json.dumps(k if isinstance(k, str) else json.dumps(k))
+
+
+def iter_json(value, level=0, rows=None):
+    """Encode value like json.dumps(value, indent=4) in pieces.
+
+    Objects are written key by key and long lists STREAM_ROWS elements at
+    a time, so no piece is larger than one slice of a column. Lists are
+    cut at rows elements, for columns appended to while writing. A
+    callable value writes itself, called with the indentation level.
+    """
+    pad = '    ' * level
+    if callable(value):
+        yield from value(level)
+    elif isinstance(value, dict) and value:
+        yield from iter_items(value.items(), level, {k: rows for k in value})
+    elif isinstance(value, list) and len(value) > STREAM_ROWS:
+        stop = len(value) if rows is None else min(len(value), rows)
+        yield '['
+        for start in range(0, stop, STREAM_ROWS):
+            part = json.dumps(value[start:min(start + STREAM_ROWS, stop)], indent=4)
+            yield (',' if start else '') + '\n' + pad + part[2:-2].replace('\n', '\n' + pad)
+        yield '\n' + pad + ']'
+    else:
+        if rows is not None and isinstance(value, list):
+            value = value[:rows]
+        # newlines only come from indentation, json escapes those in strings
+        yield json.dumps(value, indent=4).replace('\n', '\n' + pad)
+
+
+def iter_items(items, level=0, rows=None):
+    """Encode the (key, value) pairs items as an object like iter_json().
+
+    rows maps keys to the number of elements their value is cut at.
+    """
+    pad = '    ' * level
+    rows = rows or {}
+    yield '{'
+    first = True
+    for k, v in items:
+        yield (',' if not first else '') + '\n' + pad + '    ' + json_key(k) + ': '
+        yield from iter_json(v, level + 1, rows.get(k))
+        first = False
+    yield ('\n' + pad + '}') if not first else '}'
+
+
+def iter_ndjson(data, new):
+    """The stats, the metadata of new and one row per bucket, as JSON lines."""
+    rows = len(new['timeline'])
+    yield json.dumps(data) + '\n'
+    columns = [(k, v) for k, v in new.items() if k in nightscout_to_json.TIMELINE_COLUMNS]
+    columns += [('carbs_%s' % k, v) for k, v in new['carbs'].items()]
+    names = [k for k, v in columns]
+    yield json.dumps({k: v for k, v in new.items() if k not in names and k != 'carbs'}) + '\n'
+    for start in range(0, rows, STREAM_ROWS):
+        stop = min(start + STREAM_ROWS, rows)
+        lines = [json.dumps(dict(zip(names, row)))
+                 for row in zip(*[v[start:stop] for k, v in columns])]
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_all(data, new):
+    """all.json of the stats data and the timeline new, piece by piece."""
+    rows = len(new['timeline'])
+    columns = {k: rows for k in nightscout_to_json.TIMELINE_COLUMNS + ('carbs',)}
+    timeline = lambda level: iter_items(new.items(), level, columns)
+    return iter_items(itertools.chain(data.items(), [('all', timeline)]))
+
+
+@bp.route("/<url>/all.json")
 def all_data(url):
-    ret = get_data(url, request)
+    ret = get_data(url, request, resolution=request.args.get('resolution', None))
     if type(ret) == str:
         return ret
     data, new = ret
-    data['all'] = new
-    return app.response_class(
-        response=json.dumps(data, indent=4),
+    # written piece by piece, the cached data and timeline are only read
+    return current_app.response_class(
+        response=iter_all(data, new),
         status=200,
         mimetype='application/json'
     )
 
 
+@bp.route("/<url>/all.ndjson")
+def all_data_ndjson(url):
+    data, new = get_data(url, request, resolution=request.args.get('resolution', None))
+    return current_app.response_class(
+        response=iter_ndjson(data, new),
+        status=200,
+        mimetype='application/x-ndjson'
+    )
+
+
+@bp.route("/<url>/all.<any(npz, arrow):fmt>")
+def all_data_binary(url, fmt):
+    data, new = get_data(url, request, resolution=request.args.get('resolution', None))
+    f = io.BytesIO()
+    nightscout_to_json.export(new, f, fmt)
+    response = current_app.response_class(
+        response=f.getvalue(),
+        status=200,
+        mimetype='application/octet-stream'
+    )
+    response.headers['Content-Disposition'] = 'attachment; filename=all.%s' % fmt
+    return response
+
+
+def warm_up(days=WARMUP_DAYS):
+    """Run one request cycle on a synthetic site, returns the seconds taken.
+
+    Imports the download path, loads the time zones and the dateutil
+    parser and runs convert, stats, a push, the derived views and the
+    serializations once, so the first real request does not pay for the
+    cold code paths. CACHE and CLIENTS are not touched.
+    """
+    started = time.time()
+    # imported on first use by nightscout_to_json
+    import requests
+    for zone in WARMUP_TIMEZONES:
+        nightscout_to_json.LocalTime(zone, int(started))
+    nightscout_to_json.parse_ts('Mon, 19 Oct 2026 10:00:00 +0000')
+
+    profile, entries, treatments = nightscout_synthetic.synthetic_site(days)
+    tz = nightscout_synthetic.TZ
+    today = datetime.datetime.combine(
+            datetime.datetime.now(pytz.timezone(tz)).date(), datetime.time())
+    startdate = pytz.timezone(tz).localize(today - datetime.timedelta(days=days))
+    enddate = pytz.timezone(tz).localize(today)
+    client = nightscout_to_json.Nightscout('https://warmup.invalid')
+    ret, new, log = client.convert(startdate, enddate, profile, entries, treatments, tz)
+    live = nightscout_live.LiveTimeline(new, profile, entries, treatments)
+    live.push('entries', [dict(entries[-1], sgv=entries[-1]['sgv'] + 1)])
+    new, data = live.snapshot
+    nightscout_to_json.pyramid(new)
+    nightscout_to_json.rolling(new)
+    nightscout_to_json.agp(new)
+    nightscout_variability.variability(new)
+    json.dumps(data, indent=4)
+    for piece in iter_all(data, new):
+        pass
+    for piece in iter_ndjson(data, new):
+        pass
+    f = io.BytesIO()
+    nightscout_to_json.export(new, f, 'npz')
+    try:
+        nightscout_to_json.export(new, io.BytesIO(), 'arrow')
+    except ImportError:
+        pass
+    return time.time() - started
+
+
+def configure_logging():
+    # adding a handler twice is a no-op, create_app() may run repeatedly
+    logging.getLogger().addHandler(default_handler)
+
+
+def create_app(warm=None, background=False):
+    """The Flask app of the service.
+
+    With warm (default WARMUP) warm_up() runs before the app is returned,
+    or in a thread with background so the port opens right away. /ready
+    answers 503 until it is done. Prefork servers should preload the app,
+    the workers then fork warm:
+
+    gunicorn --preload 'nightscout_stats_service:create_app()'
+    """
+    configure_logging()
+    app = Flask(__name__)
+    app.logger.addHandler(default_handler)
+    app.register_blueprint(bp)
+    app.config['WARMUP_SECONDS'] = None
+    if not (WARMUP if warm is None else warm):
+        app.config['WARMUP_SECONDS'] = 0.0
+        return app
+
+    def run():
+        try:
+            seconds = warm_up()
+            logging.info('Warm-up done in %.2f s' % seconds)
+        except Exception as e:
+            # serve cold rather than not at all
+            logging.exception(e)
+            seconds = -1.0
+        app.config['WARMUP_SECONDS'] = round(seconds, 3)
+
+    if background:
+        threading.Thread(target=run, daemon=True).start()
+    else:
+        run()
+    return app
+
+
+STARTUP_SCRIPT = """
+import json, time
+started = time.time()
+import nightscout_stats_service as s
+imported = time.time()
+s.create_app(warm=False)
+created = time.time()
+cold = s.warm_up()
+warm = s.warm_up()
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'cold_cycle': cold, 'warm_cycle': warm}))
+"""
+
+
+def benchmark_startup(runs=5):
+    """Median startup times over runs fresh interpreters, in seconds.
+
+    import and create_app(warm=False) are what a worker pays before it
+    accepts requests, cold_cycle is the first synthetic request cycle and
+    warm_cycle the second one. Their difference is what warm_up() takes
+    off the first real request.
+    """
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], check=True,
+                             capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(out.stdout.splitlines()[-1]))
+    return {k: sorted(r[k] for r in results)[len(results) // 2] for k in results[0]}
+
+
 if __name__ == '__main__':
-    app.run(debug=DEBUG, host='0.0.0.0')
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark-startup', type=int, nargs='?', const=5, metavar='RUNS',
+                        help='measure import, app creation and the first request cycles')
+    args = parser.parse_args()
+    if args.benchmark_startup:
+        for k, v in benchmark_startup(args.benchmark_startup).items():
+            print('%-12s %8.1f ms' % (k, 1000 * v))
+    else:
+        # the port opens during the warm-up, /ready tells when it is done
+        create_app(background=True).run(debug=DEBUG, host='0.0.0.0')
@@ -0,0 +1,93 @@
+"""
+Synthetic Nightscout site for warm-ups, checks and profiles.
+
+Builds the profile, entries and treatments of a site with a given number
+of days of history, deterministic for a seed, without any download.
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+
+import nightscout_to_json
+
+
+TZ = 'Europe/Berlin'
+
+
+def synthetic_site(days, seed=1):
+    """Profile, entries and treatments of a site with days of history.
+
+    One sgv entry every 5 minutes, half hour temp basals and a two hour
+    one from 23:00 local time, which crosses midnight and so the chunk
+    boundaries of convert(), boluses, meals and a site change every three
+    days, ending today.
+    """
+    rng = np.random.default_rng(seed)
+    tz = pytz.timezone(TZ)
+    today = datetime.now(tz).date()
+    end = tz.localize(datetime.combine(today, datetime.min.time())) + timedelta(hours=2)
+    start = end - timedelta(days=days, hours=4)
+    ts = np.arange(int(start.timestamp()), int(end.timestamp()), 300)
+    sgv = np.clip(140 + np.cumsum(rng.integers(-6, 7, len(ts))) % 200, 40, 400)
+
+    def iso(t):
+        return datetime.fromtimestamp(t, pytz.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    entries = [{
+        '_id': '%024x' % i,
+        'type': 'sgv',
+        'sgv': int(sgv[i]),
+        'date': int(t) * 1000,
+        'dateString': iso(t),
+        'direction': 'Flat',
+        'device': 'synthetic',
+    } for i, t in enumerate(ts.tolist())]
+    seconds = nightscout_to_json.LocalTime(tz).seconds(ts).tolist()
+    treatments = []
+    for i, t in enumerate(ts.tolist()):
+        if seconds[i] == 23 * 3600:
+            treatments.append({'eventType': 'Temp Basal', 'created_at': iso(t),
+                               'rate': round(float(rng.uniform(0, 2)), 2),
+                               'duration': 120})
+        elif i % 6 == 0 and 3600 <= seconds[i] < 23 * 3600:
+            treatments.append({'eventType': 'Temp Basal', 'created_at': iso(t),
+                               'rate': round(float(rng.uniform(0, 2)), 2),
+                               'duration': 30})
+        if i % 48 == 7:
+            treatments.append({'eventType': 'Correction Bolus', 'created_at': iso(t),
+                               'insulin': round(float(rng.uniform(0.5, 3)), 2)})
+        if i % 72 == 30:
+            treatments.append({'eventType': 'Meal Bolus', 'created_at': iso(t),
+                               'carbs': int(rng.integers(10, 80)),
+                               'absorptionTime': 180})
+        if i % 864 == 100:
+            treatments.append({'eventType': 'Site Change', 'created_at': iso(t)})
+    profile = [{
+        'defaultProfile': 'Default',
+        'startDate': '2020-01-01T00:00:00.000Z',
+        'units': nightscout_to_json.MGDL,
+        'store': {'Default': {
+            'timezone': TZ,
+            'units': nightscout_to_json.MGDL,
+            'dia': 5,
+            'basal': [{'time': '00:00', 'value': 0.8}, {'time': '06:00', 'value': 1.0},
+                      {'time': '18:00', 'value': 0.9}],
+            'sens': [{'time': '00:00', 'value': 50}, {'time': '12:00', 'value': 40}],
+            'carbratio': [{'time': '00:00', 'value': 10}, {'time': '08:00', 'value': 8}],
+        }},
+    }]
+    return profile, entries, treatments
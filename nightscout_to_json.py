@@ -19,19 +19,22 @@ and put them into the format the tune program
 """
 
 from datetime import datetime, timedelta, date
-import argparse
-import dateutil.parser
+import bisect
+import calendar
 import hashlib
 import copy
 import collections
+import concurrent.futures
+import itertools
 import json
 import pytz
 import sys
+import threading
 import time
-import requests
+import urllib.parse
+import warnings
 import pytz
 import numpy as np
-from pprint import pprint
 
 
 TZ='Europe/Berlin'
@@ -41,14 +44,483 @@ MGDL_TO_MMOL = 18.0
 RANGE_LOW = 70
 RANGE_HIGH = 180
 
+# Upstream downloads are split into windows small enough to stay below
+# the server side count limit, fetched with bounded parallelism.
+WINDOW = timedelta(days=7)
+MIN_WINDOW = timedelta(hours=1)
+WINDOW_COUNT = 10000
+WINDOW_WORKERS = 4
+
+# Buckets further than this from a glucose entry on either side are
+# masked as sensor gap instead of interpolated.
+MAX_GAP = 900
+
+# Local days per chunk when converting with a process pool.
+CHUNK_DAYS = 7
+
+# API v3 only returns the fields convert() needs, paged by V3_PAGE.
+V3_PAGE = 1000
+V3_FIELDS = {
+    'entries': ('identifier', 'date', 'dateString', 'sgv', 'type',
+                'srvModified', 'isValid'),
+    'treatments': ('identifier', 'date', 'created_at', 'eventType', 'rate',
+                   'duration', 'insulin', 'carbs', 'absorptionTime',
+                   'profile', 'profileJson', 'percentage', 'timeshift',
+                   'srvModified', 'isValid'),
+}
+
 
 class DownloadError(Exception):
     pass
 
 
+def plan_windows(start, end, window=None):
+    """Split [start, end) into consecutive half-open windows."""
+    window = window or WINDOW
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window, end)))
+        start += window
+    return windows
+
+
+def schedule_seconds(x):
+    # see https://github.com/nightscout/cgm-remote-monitor/blob/46418c7ff275ae80de457209c1686811e033b5dd/lib/profilefunctions.js#L58
+    if 'time' in x:
+        p = x['time'].split(':')
+        if len(p) == 2:
+            return int(p[0])*3600 + int(p[1])*60
+    if 'timeAsSeconds' in x:
+        return int(x['timeAsSeconds'])
+    return 0
+
+
+def parse_ts(s):
+    try:
+        # much faster than dateutil for the usual ISO 8601 timestamps
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        # imported on first use, most sites never need it
+        import dateutil.parser
+        dt = dateutil.parser.parse(s)
+    return int(datetime.timestamp(dt))
+
+
+def valid_buckets(timeline, index, max_gap):
+    """Mask of the buckets with glucose entries at most max_gap apart around.
+
+    Buckets in longer gaps, before the first or after the last entry
+    would otherwise get interpolated glucose.
+    """
+    timeline = np.asarray(timeline, dtype=np.int64)
+    index = np.asarray(index, dtype=np.int64)
+    if not len(index):
+        return np.zeros(len(timeline), dtype=bool)
+    before = np.searchsorted(index, timeline, side='right') - 1
+    after = np.searchsorted(index, timeline, side='left')
+    inside = (before >= 0) & (after < len(index))
+    gap = index[np.minimum(after, len(index) - 1)] - index[np.maximum(before, 0)]
+    return inside & (gap <= max_gap)
+
+
+def valid_mask(new):
+    """The valid column of new, all buckets for timelines without one."""
+    if 'valid' in new:
+        return np.asarray(new['valid'], dtype=bool)
+    return np.ones(len(new['timeline']), dtype=bool)
+
+
+def delta_encode(values):
+    """Differences to the element before, the tune timelines store these."""
+    values = np.asarray(values)
+    return np.diff(values, prepend=values.dtype.type(0))
+
+
+def delta_decode(values):
+    """The values delta_encode() encoded, float columns up to rounding."""
+    return np.cumsum(values)
+
+
+def tune_timeline(kind, parameters=None, **columns):
+    """A timeline of the tune format with the delta encoded columns."""
+    timeline = {'type': kind}
+    if parameters is not None:
+        timeline['parameters'] = parameters
+    for k, v in columns.items():
+        timeline[k] = delta_encode(v).tolist()
+    return timeline
+
+
+def tune_columns(timeline):
+    """The columns of a tune timeline as arrays, undoing tune_timeline()."""
+    return {k: delta_decode(v) for k, v in timeline.items() if isinstance(v, list)}
+
+
+def first_of_runs(a):
+    """Mask of the elements of a differing from the one before."""
+    a = np.asarray(a)
+    return np.concatenate([[True], a[1:] != a[:-1]])[:len(a)]
+
+
+def last_of_runs(a):
+    """Mask of the elements of a differing from the one after."""
+    a = np.asarray(a)
+    return np.concatenate([a[1:] != a[:-1], [True]])[-len(a):] if len(a) else a.astype(bool)
+
+
+def temp_basal_timeline(ts, durations, rates):
+    """Start, rate and duration of the temp basals in time order ts.
+
+    Like applying them one by one: a temp basal with the start of the
+    one before replaces it, one starting while the one before still runs
+    ends that, a cancel (duration 0) ends the one before at its start.
+    Returns the three arrays and the starts of replaced temp basals.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    durations = np.asarray(durations)
+    rates = np.asarray(rates)
+    cancel = durations == 0
+    doses = np.flatnonzero(~cancel)
+    starts = np.zeros(len(ts), dtype=bool)
+    starts[doses] = first_of_runs(ts[doses])
+    # temp basal every row belongs to, -1 for cancels before the first
+    owner = np.cumsum(starts) - 1
+    first = np.flatnonzero(starts)
+    last = doses[last_of_runs(owner[doses])]
+    index = ts[first]
+    values = rates[last]
+    lengths = durations[last].copy()
+
+    # the last cancel after the last replacement sets the end
+    cancels = np.flatnonzero(cancel & (owner >= 0))
+    cancels = cancels[cancels > last[owner[cancels]]]
+    cancels = cancels[last_of_runs(owner[cancels])]
+    cancelled = np.zeros(len(index), dtype=bool)
+    cancelled[owner[cancels]] = True
+    lengths[owner[cancels]] = ts[cancels] - index[owner[cancels]]
+
+    # without a cancel the next temp basal ends a running one
+    ended = ~cancelled[:-1] & (index[:-1] + lengths[:-1] >= index[1:])
+    lengths[:-1][ended] = (index[1:] - index[:-1])[ended]
+    return index, values, lengths, ts[np.setdiff1d(doses, first)]
+
+
+def unique_order(ts, keys):
+    """Return indices ordering ts, without rows equal in ts and keys.
+
+    keys are integer or float columns identifying a record. Rows with the
+    same timestamp keep their input order. Input which is already strictly
+    ordered can contain no duplicates and is returned as is.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    if len(ts) < 2 or np.all(np.diff(ts) > 0):
+        return np.arange(len(ts))
+    rows = np.column_stack([ts] + list(keys)).astype(np.float64)
+    _, index = np.unique(rows, axis=0, return_index=True)
+    return index[np.lexsort((index, ts[index]))]
+
+
+def codes(values):
+    """Number hashable values in order of first appearance."""
+    numbers = {}
+    return np.array([numbers.setdefault(v, len(numbers)) for v in values],
+                    dtype=np.int64)
+
+
+def ingest_entries(entries, log):
+    """Return timestamps and glucose values of entries as sorted arrays.
+
+    Entries uploaded more than once (same time, type and value) are
+    dropped.
+    """
+    valid = [e for e in entries if 'sgv' in e]
+    for e in entries:
+        if 'sgv' not in e:
+            log.append('glucose entry without glucose value: %s' % repr(e))
+    ts = np.array([parse_ts(e['dateString']) for e in valid], dtype=np.int64)
+    sgv = np.array([e['sgv'] for e in valid])
+    order = unique_order(ts, [codes(e.get('type') for e in valid),
+                              sgv.astype(np.float64)])
+    if len(order) < len(valid):
+        log.append('dropped %d duplicate glucose entries' % (len(valid) - len(order)))
+    return ts[order], sgv[order]
+
+
+TREATMENT_KEYS = ('eventType', 'insulin', 'carbs', 'rate', 'duration',
+                  'absorptionTime', 'profile')
+
+
+def ingest_treatments(treatments, log):
+    """Return timestamps and treatments in time order.
+
+    Treatments uploaded more than once (same time, eventType and values)
+    are dropped.
+    """
+    ts = np.array([parse_ts(t['created_at']) for t in treatments], dtype=np.int64)
+    key = codes(tuple(t.get(k) for k in TREATMENT_KEYS) for t in treatments)
+    order = unique_order(ts, [key])
+    if len(order) < len(treatments):
+        log.append('dropped %d duplicate treatments' % (len(treatments) - len(order)))
+    return ts[order].tolist(), [treatments[i] for i in order]
+
+
+class ProfileTimeline(object):
+    """Interval index of the profile active at any point in time.
+
+    Built from all profile documents (active from their startDate) and
+    Profile Switch treatments, which select a profile by name or carry it
+    as profileJson, optionally scaled by percentage, shifted by timeshift
+    hours and limited to duration minutes.
+    """
+
+    KEYS = ('basal', 'sens', 'carbratio')
+
+    def __init__(self, profiles, treatments=()):
+        events = []
+        for doc in profiles:
+            start = doc.get('startDate') or doc.get('created_at')
+            events.append((parse_ts(start) if start else 0, 0, doc))
+        for t in treatments:
+            if t.get('eventType') == 'Profile Switch':
+                events.append((parse_ts(t['created_at']), 1, t))
+        events.sort(key=lambda x: x[:2])
+
+        self.starts = []
+        self.profiles = []
+        doc = profiles[0]
+        base = None
+        active_until = None
+        for ts, kind, e in events:
+            if active_until is not None and active_until <= ts:
+                self._add(active_until, base)
+                active_until = None
+            if kind == 0:
+                doc = e
+                base = self.compile(doc['store'][doc['defaultProfile']])
+                if active_until is None:
+                    self._add(ts, base)
+                continue
+            if e.get('profileJson'):
+                ps = json.loads(e['profileJson'])
+            elif e.get('profile') in doc['store']:
+                ps = doc['store'][e['profile']]
+            else:
+                continue
+            p = self.compile(ps, e.get('percentage'), e.get('timeshift'))
+            self._add(ts, p)
+            if e.get('duration'):
+                active_until = ts + int(float(e['duration']) * 60)
+            else:
+                base = p
+                active_until = None
+        if active_until is not None:
+            self._add(active_until, base)
+        self.starts = np.array(self.starts, dtype=np.int64)
+        self.timeshifts = np.array([p['timeshift'] for p in self.profiles])
+        # the schedules of all segments as one sorted array, keyed by
+        # segment * 86400 + seconds of the day, the first item of each
+        # schedule holds from midnight on
+        self.schedules = {}
+        for k in self.KEYS:
+            keys = []
+            for segment, p in enumerate(self.profiles):
+                index = p[k][0].astype(np.float64)
+                index[:1] = 0
+                keys.append(segment * 86400 + index)
+            self.schedules[k] = (np.concatenate(keys),
+                                 np.concatenate([p[k][1] for p in self.profiles]))
+
+    def _add(self, ts, p):
+        if p is None:
+            return
+        if self.starts and self.starts[-1] == ts:
+            self.profiles[-1] = p
+        else:
+            self.starts.append(ts)
+            self.profiles.append(p)
+
+    @classmethod
+    def compile(cls, ps, percentage=None, timeshift=None):
+        scale = float(percentage or 100) / 100
+        p = {'timeshift': int(float(timeshift or 0) * 3600)}
+        for k in cls.KEYS:
+            items = sorted(ps[k], key=schedule_seconds)
+            values = np.array([float(x['value']) for x in items])
+            # same as Nightscout: basal scales with the percentage,
+            # ISF and carb ratio inversely
+            values = values * scale if k == 'basal' else values / scale
+            p[k] = (np.array([schedule_seconds(x) for x in items]), values)
+        return p
+
+    def lookup(self, ts, seconds_of_day, key):
+        """Return the value of key for each epoch in ts.
+
+        seconds_of_day is the matching local time of day in seconds.
+        """
+        ts = np.asarray(ts, dtype=np.int64)
+        segment = np.maximum(
+                np.searchsorted(self.starts, ts, side='right') - 1, 0)
+        sod = (np.asarray(seconds_of_day) + self.timeshifts[segment]) % 86400
+        keys, values = self.schedules[key]
+        i = np.searchsorted(keys, segment * 86400 + sod, side='right') - 1
+        return values[i].astype(np.float64)
+
+
+# date.toordinal() of 1970-01-01, a Thursday
+EPOCH_ORDINAL = 719163
+
+
+class LocalTime(object):
+    """UTC offset transition table of a timezone.
+
+    Converts whole arrays of epoch seconds to local time of day, day and
+    weekday with one searchsorted, instead of one tz aware datetime per
+    element. start and end (epochs) limit the table to the transitions
+    relevant for that range.
+    """
+
+    def __init__(self, tz, start=None, end=None):
+        if isinstance(tz, str):
+            tz = pytz.timezone(tz)
+        times = getattr(tz, '_utc_transition_times', None)
+        if times:
+            transitions = [calendar.timegm(t.timetuple()) for t in times]
+            offsets = [int(info[0].total_seconds()) for info in tz._transition_info]
+        else:
+            transitions = [0]
+            offsets = [int(tz.utcoffset(datetime(1970, 1, 1)).total_seconds())]
+        transitions = np.array(transitions, dtype=np.int64)
+        offsets = np.array(offsets, dtype=np.int64)
+        first = 0
+        last = len(transitions)
+        if start is not None:
+            first = max(np.searchsorted(transitions, start, side='right') - 1, 0)
+        if end is not None:
+            last = max(np.searchsorted(transitions, end, side='right'), first + 1)
+        self.transitions = transitions[first:last]
+        self.offsets = offsets[first:last]
+        # everything before the table uses its first offset
+        self.transitions[0] = np.iinfo(np.int64).min
+
+    def local(self, ts):
+        """Local wall clock time of epochs ts, in seconds since the epoch."""
+        ts = np.asarray(ts, dtype=np.int64)
+        i = np.searchsorted(self.transitions, ts, side='right') - 1
+        return ts + self.offsets[i]
+
+    def utc(self, local):
+        """Epochs of local wall clock times local, the inverse of local().
+
+        Times skipped by a DST change map with the offset after it,
+        repeated times to their first occurrence.
+        """
+        local = np.asarray(local, dtype=np.int64)
+        i = np.searchsorted(self.transitions, local - self.offsets.max(), side='right') - 1
+        ts = local - self.offsets[i]
+        i = np.searchsorted(self.transitions, ts, side='right') - 1
+        return local - self.offsets[i]
+
+    def seconds(self, ts):
+        """Local seconds since midnight."""
+        return self.local(ts) % 86400
+
+    def hours(self, ts):
+        """Local time of day in fractional hours."""
+        return self.seconds(ts) / 3600.0
+
+    def days(self, ts):
+        """Local day, counted in days since 1970-01-01."""
+        return self.local(ts) // 86400
+
+    def weekdays(self, ts):
+        """Local weekday, Monday is 0 like date.weekday()."""
+        return (self.days(ts) + 3) % 7
+
+    @staticmethod
+    def date(day):
+        return date.fromordinal(EPOCH_ORDINAL + int(day))
+
+
+def convert_buckets(chunk):
+    """Bucket columns first to last of Nightscout.convert().
+
+    chunk holds the glucose entries around the buckets, the events reaching
+    into them and the first bucket of every age counter, so chunks of one
+    range convert independently to the same values as the whole range.
+    """
+    first = chunk['first']
+    nbuckets = chunk['last'] - first
+    bucket_size = chunk['size']
+    min_ts = chunk['min_ts']
+
+    def get_bucket(ts):
+       return (ts - min_ts) // bucket_size - first
+
+    timeline = min_ts + bucket_size * np.arange(first, chunk['last'], dtype=np.int64)
+    index, values = chunk['glucose']
+    hours = chunk['localtime'].hours(timeline)
+    seconds = chunk['localtime'].seconds(timeline)
+    profiles = chunk['profiles']
+    basal_rate = profiles.lookup(timeline, seconds, 'basal')
+    prog_basal = basal_rate * bucket_size / 3600
+    columns = {
+        'timeline': timeline,
+        'glucose': np.interp(timeline, index, values),
+        'valid': valid_buckets(timeline, index, chunk['max_gap']),
+        'hours': hours,
+        'basal_rate': basal_rate,
+        'isf_schedule': profiles.lookup(timeline, seconds, 'sens'),
+        'carb_ratio_schedule': profiles.lookup(timeline, seconds, 'carbratio'),
+        'prog_basal': prog_basal,
+    }
+
+    # Insulin delivered by temp basals and the seconds they cover per
+    # bucket, the scheduled rate for those seconds is subtracted below.
+    temp_amount = np.zeros(nbuckets)
+    temp_seconds = np.zeros(nbuckets)
+    for ts, rate, duration in chunk['temp_basals']:
+       i = 0
+       bucket = get_bucket(ts)
+       while duration > 0:
+          covered = min(bucket_size, duration)
+          if bucket + i < nbuckets:
+              if bucket + i >= 0:
+                  temp_amount[bucket + i] += rate / 3600 * covered
+                  temp_seconds[bucket + i] += covered
+          else:
+              break
+          duration -= bucket_size
+          i += 1
+    columns['basal'] = temp_amount - basal_rate / 3600 * temp_seconds
+
+    bolus = np.zeros(nbuckets)
+    for ts, units in chunk['boluses']:
+        bolus[get_bucket(ts)] += units
+    columns['bolus'] = bolus
+    columns['insulin'] = bolus + columns['basal'] + prog_basal
+
+    columns['carbs'] = {}
+    for absorption, items in chunk['meals']:
+        nc = np.zeros(nbuckets)
+        for ts, amount in items:
+            nc[get_bucket(ts)] += amount
+        columns['carbs'][absorption] = nc
+
+    # seconds since the first change, -1 before
+    buckets = np.arange(first, chunk['last'])
+    for key, changed in zip(('iage', 'cage', 'sage'), chunk['ages']):
+        if changed is None:
+            columns[key] = np.full(nbuckets, -1.0)
+        else:
+            columns[key] = np.where(buckets >= changed,
+                                    (buckets - changed) * bucket_size, -1).astype(np.float64)
+    return columns
+
+
 class Nightscout(object):
 
-  def __init__(self, url, secret=None, token=None, hashed_secret=None):
+  def __init__(self, url, secret=None, token=None, hashed_secret=None,
+               archive=None, limiter=None):
     self.url = url
     self.secret = None
     self.token = token
@@ -57,7 +529,25 @@ class Nightscout(object):
     elif secret:
         self.secret = hashlib.sha1(secret.encode('utf-8')).hexdigest()
     self.batch = []
-
+    # nightscout_replay.Archive recording or replaying all requests
+    self.archive = archive
+    if archive is not None and token and token not in archive.secrets:
+        archive.secrets.append(token)
+    # nightscout_limiter.HostLimiter admitting the requests to the site
+    self.limiter = limiter
+
+  def get(self, url, params=None, headers=None):
+    if self.limiter:
+        with self.limiter.slot(urllib.parse.urlparse(self.url).netloc):
+            return self.send(url, params, headers)
+    return self.send(url, params, headers)
+
+  def send(self, url, params=None, headers=None):
+    if self.archive:
+        return self.archive.get(self.url, url, params=params, headers=headers)
+    # imported on first use, like the rest of the download path
+    import requests
+    return requests.get(url, params=params, headers=headers)
 
   def download(self, path, params=None):
     url = self.url + '/api/v1/' + path + '.json'
@@ -71,17 +561,77 @@ class Nightscout(object):
 
     params = params or {}
 
-    response = requests.get(url, params=params, headers=headers)
+    response = self.get(url, params=params, headers=headers)
     if response.status_code != 200:
         print('Server Error', response.status_code, response.text)
         raise DownloadError(response.status_code, response.text)
     return response.json()
 
+  def download_window(self, path, field, start, end, count=None):
+    """Download all documents of path with start <= field < end.
+
+    A window which hits the count limit was truncated by the server and
+    is split in halves until every part fits.
+    """
+    count = count or WINDOW_COUNT
+    items = self.download(path, {
+        'find[%s][$gte]' % field: start.astimezone(pytz.utc).isoformat(),
+        'find[%s][$lt]' % field: end.astimezone(pytz.utc).isoformat(),
+        'count': str(count)})
+    if len(items) >= count and end - start > MIN_WINDOW:
+        middle = start + (end - start) / 2
+        items = (self.download_window(path, field, start, middle, count) +
+                 self.download_window(path, field, middle, end, count))
+    return items
+
+  def download_range(self, path, field, start, end, window=None, workers=None):
+    """Download path between start and end in parallel fixed windows.
+
+    Results are merged in chronological window order and documents
+    returned by more than one window are dropped.
+    """
+    windows = plan_windows(start, end, window)
+    executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or WINDOW_WORKERS)
+    try:
+        parts = [executor.submit(self.download_window, path, field, w[0], w[1])
+                 for w in windows]
+        done, _ = concurrent.futures.wait(
+                parts, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for part in done:
+            # raises the error of a failed window
+            part.result()
+        items = []
+        seen = set()
+        for part in parts:
+            for item in part.result():
+                key = (item.get('_id') or item.get('identifier') or
+                       json.dumps(item, sort_keys=True))
+                if key in seen:
+                    continue
+                seen.add(key)
+                items.append(item)
+    except BaseException:
+        # the first failed window fails the range, the windows not
+        # started yet are cancelled and the running ones not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return items
+
   def convert(self, startdate, enddate,
               profile, entries, treatments, tz,
-              bucket_size=None):
+              bucket_size=None, max_gap=None, processes=None,
+              chunk_days=CHUNK_DAYS):
+    """Convert downloaded data to the tune timelines ret and the buckets new.
+
+    With processes, the buckets are converted in chunks of chunk_days
+    local days by a pool of that many processes. The result is the same.
+    """
     if not bucket_size:
         bucket_size = 300
+    if not max_gap:
+        max_gap = MAX_GAP
     log = []
     defaultProfile = profile[0]['defaultProfile']
     ps = profile[0]['store'][defaultProfile]
@@ -104,15 +654,8 @@ class Nightscout(object):
            'timelines': [],
     }
     ret = copy.deepcopy(common)
-    def seconds(x):
-        # see https://github.com/nightscout/cgm-remote-monitor/blob/46418c7ff275ae80de457209c1686811e033b5dd/lib/profilefunctions.js#L58
-        if 'time' in x:
-            p = x['time'].split(':')
-            if len(p) == 2:
-                return int(p[0])*3600 + int(p[1])*60
-        if 'timeAsSeconds' in x:
-            return int(x['timeAsSeconds'])
-        return 0
+    seconds = schedule_seconds
+    profiles = ProfileTimeline(profile, treatments)
 
     ret.update({
             'insulin_sensitivity_schedule': {
@@ -130,11 +673,9 @@ class Nightscout(object):
     })
 
     def lookup(hour, schedule):
-        minutes = hour * 60
-        for i, v in enumerate(schedule['index']):
-            if v >= minutes:
-                return schedule['values'][i]
-        return schedule['values'][-1]
+        # the entry which started last before the given hour
+        i = bisect.bisect_right(schedule['index'], hour * 60) - 1
+        return schedule['values'][max(i, 0)]
 
 
     def lookup_basal(hour):
@@ -146,92 +687,25 @@ class Nightscout(object):
     def lookup_isf(hour):
         return lookup(hour, ret['insulin_sensitivity_schedule'])
 
-    def encode(series):
-        o = 0
-        for i, v in enumerate(series):
-            series[i] -= o
-            o = v
-
-    buckets = {
-       'start_ts': None,
-       'end_ts': None,
-       'size': 300,
-       'hours': [],
-       'glucose': [],
-       'insulin': [],
-       'carbs': [],
-    }
-
-    basal_default_timeline = {
-            'type': 'basal',
-            'parameters': ret['basal_insulin_parameters'],
-            'index': [],
-            'values': [],
-            'durations': [],
-    }
-
-    glucose = {
-            'type': 'glucose',
-            'index': [],
-            'values': [],
-	    'hours': [],
-    }
-    start_ts = None
-    min_dt = None
-    max_dt = None
-    offset = None
-    offset_sgv = None
-    for e in sorted(entries, key=lambda x: x['dateString']):
-        dt = dateutil.parser.parse(e['dateString'])
-        lt = dt.astimezone(tz)
-        ots = int(datetime.timestamp(dt))
-        # print(e['dateString'], dt)
-        min_dt = min(min_dt or dt, dt)
-        max_dt = max(max_dt or dt, dt)
-        if 'sgv' not in e:
-            log.append('glucose entry without glucose value: %s' % repr(e))
-            continue
-        glucose['index'].append(ots)
-        glucose['values'].append(e['sgv'])
-        glucose['hours'].append(lt.hour + (lt.minute*60 + lt.second)/3600.0)
-
-        if len(glucose['index']) >= 2:
-            default_basal = lookup_basal(lt.hour)
-            basal_default_timeline['index'].append(glucose['index'][-2])
-            basal_default_timeline['values'].append(default_basal)
-            basal_default_timeline['durations'].append(ots - glucose['index'][-2])
-    # min_ts = int(datetime.timestamp(min_dt))
-    # max_ts = int(datetime.timestamp(max_dt))
+    entry_ts, entry_sgv = ingest_entries(entries, log)
     min_ts = int(datetime.timestamp(startdate))
     max_ts = int(datetime.timestamp(enddate))
-
+    localtime = LocalTime(tz, min(entry_ts[:1].tolist() + [min_ts]),
+                          max(entry_ts[-1:].tolist() + [max_ts]))
+    entry_hours = localtime.hours(entry_ts)
     nbuckets = (max_ts - min_ts) // bucket_size
-    new_timeline = np.array([min_ts + i*bucket_size for i in range(nbuckets)])
-    new_glucose = np.interp(new_timeline, glucose['index'], glucose['values'])
-
-    # new_hours = np.zeros(nbuckets)
-    new_hours = np.interp(new_timeline, glucose['index'], glucose['hours'])
-
-    new_prog_basal = np.array([lookup_basal(int(h))*bucket_size/3600 for h in new_hours])
-    new_bolus = np.zeros(nbuckets)
-    new_carbs = np.zeros(nbuckets)
-    new_basal = np.zeros(nbuckets)
-
-    new_iage = np.zeros(nbuckets)
-    new_cage = np.zeros(nbuckets)
-    new_sage = np.zeros(nbuckets)
 
     def get_bucket(ts):
        return (ts - min_ts) // bucket_size
 
-    encode(glucose['index'])
-    encode(glucose['values'])
-    encode(glucose['hours'])
-    ret['timelines'].append(glucose)
-    encode(basal_default_timeline['index'])
-    encode(basal_default_timeline['values'])
-    encode(basal_default_timeline['durations'])
-    ret['timelines'].append(basal_default_timeline)
+    ret['timelines'].append(tune_timeline(
+            'glucose', index=entry_ts, values=entry_sgv, hours=entry_hours))
+    # the scheduled basal between two glucose entries
+    ret['timelines'].append(tune_timeline(
+            'basal', ret['basal_insulin_parameters'],
+            index=entry_ts[:-1],
+            values=profiles.lookup(entry_ts[1:], localtime.seconds(entry_ts[1:]), 'basal'),
+            durations=np.diff(entry_ts)))
 
     basal = []
     bolus = []
@@ -239,16 +713,9 @@ class Nightscout(object):
     iage = []
     sage = []
     carbs = collections.defaultdict(list)
-    for t in sorted(treatments, key=lambda x: x['created_at']):
-        dt = dateutil.parser.parse(t['created_at'])
-        lt = dt.astimezone(tz)
-        ts = int(datetime.timestamp(dt))
+    for ts, t in zip(*ingest_treatments(treatments, log)):
         if t['eventType'] == 'Temp Basal':
-           # if the temp basal is longer than the schedule,
-           # needs to split up in 30 minute intervals.
-           default_basal = lookup_basal(lt.hour)
-           delta = t['rate'] - default_basal
-           basal.append((ts, delta, t['duration']*60, t['rate'], lt))
+           basal.append((ts, t['duration']*60, t['rate']))
         elif t['eventType'] == 'Correction Bolus':
            bolus.append((ts, t['insulin']))
         elif t['eventType'] == 'Bolus':
@@ -267,139 +734,125 @@ class Nightscout(object):
             sage.append((ts, True))
         elif t['eventType'].startswith('Log.'):
             pass
+        elif t['eventType'] == 'Profile Switch':
+            # handled by ProfileTimeline
+            pass
         else:
            print('ignored', t['eventType'])
            pass
 
-    basal_timeline = {
-            'type': 'basal',
-            'parameters': ret['basal_insulin_parameters'],
-            'index': [],
-            'values': [],
-            'durations': [],
-            'ots': [],
-            'lt': [],
-            'rate': [],
-    }
-    offset = None
-    active_until = None
-    for ts, rate, duration, rate, lt in basal:
-        ots = ts
-
-        if duration == 0:
-            if not basal_timeline['index']:
-                    continue
-            delta = ots - basal_timeline['index'][-1]
-            basal_timeline['durations'][-1] = delta
-            active_until = None
-            continue
-
-        if active_until and active_until >= ots:
-            # End previous dose
-            delta = ots - basal_timeline['index'][-1]
-            basal_timeline['durations'][-1] = delta
-
-        if len(basal_timeline['index']) and ts == basal_timeline['index'][-1]:
-            log.append('overwrite duplicate basal ts: %d' % ts)
-            basal_timeline['durations'][-1] = duration
-            basal_timeline['values'][-1] = rate
-        else:
-            basal_timeline['index'].append(ots)
-            basal_timeline['values'].append(rate)
-            basal_timeline['durations'].append(duration)
-            basal_timeline['lt'].append(lt)
-            basal_timeline['rate'].append(rate)
-        active_until = ots + duration
-
-    for ts, _, duration, rate, lt in zip(basal_timeline['index'], basal_timeline['values'],
-                                   basal_timeline['durations'], basal_timeline['rate'],
-                                   basal_timeline['lt']):
-       i = 0
-       bucket = get_bucket(ts)
-       while duration > 0:
-          value = rate - lookup_basal(lt.hour)
-          p = value / 3600 * min(bucket_size, duration)
-          # print(lt.hour, duration, lookup_basal(lt.hour), rate, value, p)
-          if bucket + i < len(new_basal):
-              if bucket + i >= 0:
-                  new_basal[bucket + i] += p
-          else:
-              break
-          duration -= bucket_size
-          i += 1
-          lt += timedelta(seconds=bucket_size)
-    del basal_timeline['lt']
-    del basal_timeline['rate']
-    encode(basal_timeline['index'])
-    encode(basal_timeline['values'])
-    encode(basal_timeline['durations'])
-    ret['timelines'].append(basal_timeline)
-
-    bolus_timeline = {
-            'type': 'bolus',
-            'parameters': ret['basal_insulin_parameters'],
-            'index': [],
-            'values': [],
-    }
-    offset = None
-    for ts, units in bolus:
-        ots = ts
-        if bolus_timeline['index'] and ts == bolus_timeline['index'][-1]:
-            log.append('drop duplicate bolus ts', ts)
-            continue
-        bolus_timeline['index'].append(ots)
-        bolus_timeline['values'].append(units)
-        bucket = get_bucket(ts)
-        if bucket < len(new_bolus) and bucket >= 0:
-            new_bolus[bucket] += units
-        else:
-            log.append('Found bolus out of bounds: ts %d, units %.2f, last bucket %d, max_ts %d' % (ts, units, len(new_bolus), max_ts))
-
-    encode(bolus_timeline['index'])
-    encode(bolus_timeline['values'])
-    ret['timelines'].append(bolus_timeline)
-
-    new_carbs = {}
+    def event_columns(events, n):
+        # events as n arrays, empty ones as float
+        return [np.array(c) for c in zip(*events)] or [np.zeros(0)] * n
+
+    basal_ts, basal_durations, basal_rates = event_columns(basal, 3)
+    index, values, durations, replaced = temp_basal_timeline(
+            basal_ts, basal_durations, basal_rates)
+    for ts in replaced.tolist():
+        log.append('overwrite duplicate basal ts: %d' % ts)
+    temp_basals = list(zip(index.tolist(), values.tolist(), durations.tolist()))
+    ret['timelines'].append(tune_timeline(
+            'basal', ret['basal_insulin_parameters'],
+            index=index, values=values, durations=durations))
+
+    def in_range(ts, values, message):
+        # events in the buckets, the others are logged
+        buckets = get_bucket(ts)
+        inside = (buckets >= 0) & (buckets < nbuckets)
+        for t, v in zip(ts[~inside].tolist(), values[~inside].tolist()):
+            log.append(message(t, v))
+        return list(zip(ts[inside].tolist(), values[inside].tolist()))
+
+    bolus_ts, bolus_units = event_columns(bolus, 2)
+    first = first_of_runs(bolus_ts)
+    for ts in bolus_ts[~first].tolist():
+        log.append('drop duplicate bolus ts: %d' % ts)
+    bolus_ts = bolus_ts[first].astype(np.int64)
+    bolus_units = bolus_units[first]
+    boluses = in_range(bolus_ts, bolus_units, lambda ts, units: (
+        'Found bolus out of bounds: ts %d, units %.2f, last bucket %d, max_ts %d' % (
+            ts, units, nbuckets, max_ts)))
+    ret['timelines'].append(tune_timeline(
+            'bolus', ret['basal_insulin_parameters'], index=bolus_ts, values=bolus_units))
+
+    meals = []
     for absorption, items in carbs.items():
-        carb_timeline = {
-            'type': 'carb',
-            'parameters': { 'delay': 5.0, 'duration': absorption },
-            'index': [],
-            'values': [],
-        }
-        offset = None
-
-        nc = np.zeros(nbuckets)
-        for ts, amount in items:
-            ots = ts
-            #if len(carb_timeline['index']) and ts == carb_timeline['index'][-1]:
-            #    print('tweak duplicate carb ts', ts)
-            #    ts += 1
-            bucket = get_bucket(ts)
-            if bucket < len(nc) and bucket >= 0:
-                nc[bucket] += amount
-            else:
-                log.append('Found carb entry out of bounds: ts %d, max_ts %d, carbs %f' % (ts, max_ts, amount))
-            carb_timeline['index'].append(ots)
-            carb_timeline['values'].append(amount)
-        encode(carb_timeline['index'])
-        encode(carb_timeline['values'])
-        ret['timelines'].append(carb_timeline)
-        new_carbs[absorption] = nc.tolist()
-
-
-    for src, target in ((iage, new_iage), (cage, new_cage), (sage, new_sage)):
-        for ts, _ in src:
-            bucket = get_bucket(ts)
-            if bucket < len(target) and bucket >= 0:
-                target[bucket] = 1
-        age = -1
-        for i, v in enumerate(target):
-            if age >= 0:
-                age += bucket_size
-            elif v == 1:
-                age = 0
-            target[i] = age
+        carb_ts, amounts = event_columns(items, 2)
+        meals.append((absorption, in_range(carb_ts, amounts, lambda ts, amount: (
+            'Found carb entry out of bounds: ts %d, max_ts %d, carbs %f' % (
+                ts, max_ts, amount)))))
+        ret['timelines'].append(tune_timeline(
+                'carb', {'delay': 5.0, 'duration': absorption},
+                index=carb_ts, values=amounts))
+
+    # The age counters start at the first change within the range.
+    ages = []
+    for src in (iage, cage, sage):
+        buckets_changed = [get_bucket(ts) for ts, _ in src]
+        buckets_changed = [b for b in buckets_changed if 0 <= b < nbuckets]
+        ages.append(min(buckets_changed) if buckets_changed else None)
+
+    # Day aligned chunks, each gets the glucose entries and events
+    # reaching into it. Temp basals crossing into a chunk carry over.
+    bounds = [0, nbuckets]
+    if processes and processes > 1 and nbuckets:
+        days = localtime.days(min_ts + bucket_size * np.arange(nbuckets))
+        day_starts = np.flatnonzero(np.diff(days)) + 1
+        bounds = [0] + day_starts[chunk_days - 1::chunk_days].tolist() + [nbuckets]
+    # All events are in time order, a chunk gets a slice of each. Temp
+    # basals are found by the last bucket they reach, made monotonic for
+    # searchsorted and then checked one by one.
+    reach = get_bucket(index) + durations / bucket_size + 1
+    max_reach = np.maximum.accumulate(reach) if len(reach) else reach
+    bolus_starts = np.array([ts for ts, _ in boluses], dtype=np.int64)
+    meal_starts = [np.array([ts for ts, _ in items], dtype=np.int64)
+                   for _, items in meals]
+
+    def in_chunk(events, starts, first, last):
+        return events[np.searchsorted(starts, min_ts + first * bucket_size):
+                      np.searchsorted(starts, min_ts + last * bucket_size)]
+
+    chunks = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        lo = max(np.searchsorted(entry_ts, min_ts + first * bucket_size, side='left') - 1, 0)
+        hi = np.searchsorted(entry_ts, min_ts + (last - 1) * bucket_size, side='right') + 1
+        basal_lo = np.searchsorted(max_reach, first, side='right')
+        basal_hi = np.searchsorted(index, min_ts + last * bucket_size)
+        chunks.append({
+            'first': first,
+            'last': last,
+            'size': bucket_size,
+            'min_ts': min_ts,
+            'max_gap': max_gap,
+            'glucose': (entry_ts[lo:hi], entry_sgv[lo:hi]),
+            'localtime': localtime,
+            'profiles': profiles,
+            'temp_basals': list(itertools.compress(
+                    temp_basals[basal_lo:basal_hi],
+                    (reach[basal_lo:basal_hi] > first).tolist())),
+            'boluses': in_chunk(boluses, bolus_starts, first, last),
+            'meals': [(absorption, in_chunk(items, starts, first, last))
+                      for (absorption, items), starts in zip(meals, meal_starts)],
+            'ages': ages,
+        })
+    if len(chunks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            parts = list(executor.map(convert_buckets, chunks))
+    else:
+        parts = [convert_buckets(c) for c in chunks]
+    columns = {k: np.concatenate([p[k] for p in parts])
+               for k in parts[0] if k != 'carbs'}
+    new_carbs = {absorption: np.concatenate([p['carbs'][absorption] for p in parts]).tolist()
+                 for absorption, _ in meals}
+
+    new_timeline = columns['timeline']
+    new_valid = columns['valid']
+    if not new_valid.all():
+        log.append('masked %d of %d buckets as sensor gaps' % (
+            nbuckets - new_valid.sum(), nbuckets))
+    new_basal = columns['basal']
+    new_prog_basal = columns['prog_basal']
+    new_bolus = columns['bolus']
 
 
 
@@ -413,20 +866,21 @@ class Nightscout(object):
     'basal_rates': [lookup_basal(h) for h in range(24)],
 
     'timeline': new_timeline.tolist(),
-    'glucose': new_glucose.tolist(),
-    'hours': new_hours.tolist(),
+    'glucose': columns['glucose'].tolist(),
+    'valid': new_valid.tolist(),
+    'hours': columns['hours'].tolist(),
     'prog_basal': new_prog_basal.tolist(),
+    'basal_rate': columns['basal_rate'].tolist(),
+    'isf_schedule': columns['isf_schedule'].tolist(),
+    'carb_ratio_schedule': columns['carb_ratio_schedule'].tolist(),
     'bolus': new_bolus.tolist(),
     'basal': new_basal.tolist(),
     'carbs': new_carbs,
-    'iage': new_iage.tolist(),
-    'cage': new_cage.tolist(),
-    'sage': new_sage.tolist(),
+    'iage': columns['iage'].tolist(),
+    'cage': columns['cage'].tolist(),
+    'sage': columns['sage'].tolist(),
+    'insulin': columns['insulin'].tolist(),
     }
-    new['insulin'] = []
-    for i in range(len(new['bolus'])):
-        new['insulin'].append(
-            new['bolus'][i] + new['basal'][i] + new['prog_basal'][i])
     for v in new_basal + new_prog_basal:
        if v < -0.1:
           log.append(v)
@@ -440,12 +894,184 @@ class Nightscout(object):
     return ret, new, log
 
 
+
+def epoch_ms(dt):
+    return int(datetime.timestamp(dt) * 1000)
+
+
+class NightscoutV3(Nightscout):
+  """Client downloading entries and treatments through API v3.
+
+  Only the fields in V3_FIELDS are requested, paged with limit/skip.
+  Downloaded documents are kept, so that later downloads of the same
+  range only fetch what changed since (by srvModified) from the history
+  endpoint. Documents before the start of the last download are dropped.
+  Profiles are still read through API v1, and so is everything else once
+  API v3 refused the credentials.
+  """
+
+  def __init__(self, url, secret=None, token=None, hashed_secret=None,
+               archive=None, limiter=None):
+    super().__init__(url, secret=secret, token=token, hashed_secret=hashed_secret,
+                     archive=archive, limiter=limiter)
+    self.jwt = None
+    self.synced = {}
+    # set when API v3 answered 401 or 403
+    self.v1 = False
+    # several threads may share the client and its synced documents
+    self.lock = threading.RLock()
+
+  def supported(self):
+    import requests
+    try:
+        response = self.get(self.url + '/api/v3/version')
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+  def headers(self):
+    headers = {
+            'Content-Type': 'application/json',
+    }
+    if self.token:
+        # API v3 does not accept access tokens directly, exchange for a JWT
+        if not self.jwt:
+            response = self.get(
+                    self.url + '/api/v2/authorization/request/' + self.token)
+            if response.status_code != 200:
+                raise DownloadError(response.status_code, response.text)
+            self.jwt = response.json()['token']
+        headers['Authorization'] = 'Bearer ' + self.jwt
+    # there is no api-secret header in API v3, without a token only
+    # public sites can be read
+    return headers
+
+  def download_v3(self, path, params=None):
+    url = self.url + '/api/v3/' + path
+    response = self.get(url, params=params or {}, headers=self.headers())
+    if response.status_code != 200:
+        print('Server Error', response.status_code, response.text)
+        raise DownloadError(response.status_code, response.text)
+    j = response.json()
+    # newer servers wrap the documents as {"status": 200, "result": [...]}
+    return j['result'] if isinstance(j, dict) else j
+
+  def download_window(self, path, field, start, end, count=None):
+    """Download all documents of path with start <= date < end.
+
+    API v3 normalizes the date field for every collection, so it is used
+    instead of field.
+    """
+    if self.v1:
+        return super().download_window(path, field, start, end, count)
+    params = {
+        'fields': ','.join(V3_FIELDS[path]),
+        'sort': 'date',
+        'limit': V3_PAGE,
+        'date$gte': epoch_ms(start),
+        'date$lt': epoch_ms(end),
+    }
+    items = []
+    while True:
+        page = self.download_v3(path, dict(params, skip=len(items)))
+        items.extend(page)
+        if len(page) < V3_PAGE:
+            return items
+
+  def download_range(self, path, field, start, end, window=None, workers=None):
+    if not self.v1:
+        try:
+            return self.download_range_v3(path, field, start, end, window, workers)
+        except DownloadError as e:
+            if e.args[0] not in (401, 403):
+                raise
+            print('API v3 refused the credentials, using v1 for', self.url)
+            self.v1 = True
+    return super().download_range(path, field, start, end, window, workers)
+
+  def download_range_v3(self, path, field, start, end, window=None, workers=None):
+    with self.lock:
+        state = self.synced.get(path)
+        if state is None or start < state['start']:
+            items = super().download_range(path, field, start, end, window, workers)
+            state = self.synced[path] = {'start': start, 'modified': 0, 'docs': {}}
+            self.merge(state, items)
+        else:
+            self.sync(path)
+        self.prune(state, start)
+        lo, hi = epoch_ms(start), epoch_ms(end)
+        return [d for d in state['docs'].values() if lo <= d.get('date', 0) < hi]
+
+  def prune(self, state, start):
+    """Drop the documents before start, an earlier start downloads again.
+
+    Documents after the range stay, the history endpoint does not return
+    them again for the next range.
+    """
+    lo = epoch_ms(start)
+    state['docs'] = {k: d for k, d in state['docs'].items()
+                     if d.get('date', 0) >= lo}
+    state['start'] = max(state['start'], start)
+
+  def merge(self, state, items):
+    changed = []
+    deleted = []
+    for doc in items:
+        state['modified'] = max(state['modified'], doc.get('srvModified', 0))
+        if doc.get('isValid', True) is False:
+            state['docs'].pop(doc['identifier'], None)
+            deleted.append(doc)
+        else:
+            state['docs'][doc['identifier']] = doc
+            changed.append(doc)
+    return changed, deleted
+
+  def sync(self, path):
+    """Apply all changes to path since the last download.
+
+    Returns the new or changed documents and the deleted ones.
+    """
+    with self.lock:
+        state = self.synced[path]
+        changed = []
+        deleted = []
+        while True:
+            page = self.download_v3('%s/history/%d' % (path, state['modified']), {
+                'fields': ','.join(V3_FIELDS[path]),
+                'limit': V3_PAGE,
+            })
+            c, d = self.merge(state, page)
+            changed.extend(c)
+            deleted.extend(d)
+            if len(page) < V3_PAGE:
+                return changed, deleted
+
+
+def connect(url, api=None, token=None, hashed_secret=None, archive=None,
+            limiter=None):
+    """Return a client for url, api is one of v1 (default), v3 or auto.
+
+    auto only uses API v3 with a token, which it needs for reading.
+    """
+    if api == 'v3' or (api == 'auto' and token):
+        dl = NightscoutV3(url, token=token, hashed_secret=hashed_secret,
+                          archive=archive, limiter=limiter)
+        if api == 'v3' or dl.supported():
+            return dl
+    return Nightscout(url, token=token, hashed_secret=hashed_secret,
+                      archive=archive, limiter=limiter)
+
+
 class Stats(dict):
 
     def add(self, other):
         for x, v in other.items():
             self[x] = self.get(x, 0) + v
 
+    def sub(self, other):
+        for x, v in other.items():
+            self[x] = self.get(x, 0) - v
+
     def __add__(self, other):
         return self.__radd__(other)
 
@@ -464,18 +1090,24 @@ class Stats(dict):
 
     def format(self, other=None, norm=1):
         r = {}
+        # glucose metrics of no valid samples are unknown, not 0
+        samples = self.get('samples', 0)
         for k, v in self.items():
             if k in ('insulin', 'carbs',
                      'basal', 'prog_basal'):
                 r[k] = round(v/norm, 1)
+            elif k in ('glucose',) and not samples:
+                r[k] = r['a1c'] = None
             elif k in ('glucose',):
-                avg = v/self.get('samples', 1)
+                avg = v/samples
                 r[k] = round(avg, 1)
                 units = self.get('units', MGDL)
                 avg_mgdl = avg if units == MGDL else avg * MGDL_TO_MMOL
                 r['a1c'] = round((avg_mgdl + 46.7) / 28.7, 1)
             elif k in ('range_low', 'range_high', ):
-                r[k] = round(100 * v/self.get('samples', 1), 1)
+                r[k] = round(100 * v/samples, 1) if samples else None
+            elif k in ('buckets',):
+                r['coverage'] = round(100 * self.get('samples', 0)/v, 1)
             elif k in ('samples', 'units', ):
                 pass
             else:
@@ -485,135 +1117,438 @@ class Stats(dict):
         return r
 
 
-def stats(new):
-    bg_units = new['units']
-    j = {
-      'tz': new['tz'],
-      'units': bg_units
+WEEK_PARTS = collections.OrderedDict((
+    ('Week', (0, 1, 2, 3, 4)),
+    ('Weekend', (5, 6)),
+))
+
+DAYPARTS = collections.OrderedDict((
+    ('Night', (0, 1, 2, 3, 4, 5, 21, 22, 23)),
+    ('Breakfast', (6, 7, 8, 9)),
+    ('Snack', (10, 11)),
+    ('Lunch', (12, 13)),
+    ('SnackAfternoon', (14, 15, 16, 17)),
+    ('Dinner', (18, 19, 20)),
+))
+
+
+def glucose_range(units, low=RANGE_LOW, high=RANGE_HIGH):
+    """Return the glucose range low and high (in mg/dl) in units."""
+    if units != MGDL:
+        return low / MGDL_TO_MMOL, high / MGDL_TO_MMOL
+    return low, high
+
+
+def groups(new):
+    """Group indices of the buckets of new by local day, weekday and hour.
+
+    'day' numbers the days of the timeline from 0, 'days' holds their
+    local day since the epoch (see LocalTime.date()).
+    """
+    timeline = new['timeline']
+    localtime = LocalTime(new['tz'], timeline[0], timeline[-1])
+    days, day = np.unique(localtime.days(timeline), return_inverse=True)
+    return {
+        'days': days,
+        'day': day,
+        'weekday': (days[day] + 3) % 7,
+        'hour': np.asarray(new['hours']).astype(np.int64),
     }
 
-    overall = Stats()
-    daily = []
-    stats = {}
-    stats_hourly = {}
-    stats_wd_hourly = {}
-    wd_count = {}
-    for i in range(24):
-        stats_hourly[i] = Stats()
-        for wd in range(7):
-            stats_wd_hourly[(wd, i)] = Stats()
-            wd_count[wd] = 0
-
-
-    lastdate = None
-    range_low = RANGE_LOW
-    range_high = RANGE_HIGH
-    if bg_units != MGDL:
-        range_low = range_low / MGDL_TO_MMOL
-        range_high = range_high / MGDL_TO_MMOL
-    day = Stats()
-    for i, t in enumerate(new['timeline']):
-        dt = datetime.fromtimestamp(new['timeline'][i])
-        if not lastdate or dt.date() != lastdate:
-            if lastdate:
-                day.update({
-                    'date': lastdate.isoformat(),
-                    'weekday': lastdate.strftime('%a'),
-                })
-                daily.append(day)
-            lastdate = dt.date()
-            wd_count[lastdate.weekday()] += 1
-            day = Stats()
-
-        point = Stats(
-            glucose = new['glucose'][i],
-            range_low = 1 if new['glucose'][i] < range_low else 0,
-            range_high = 1 if new['glucose'][i] > range_high else 0,
+
+class Aggregates(object):
+    """The sums behind stats(): overall, per day, hour and weekday and hour.
+
+    Built from the buckets of new in one pass. Buckets appended to new
+    later are added with append(), a changed bucket is updated in place
+    with replace(), both only touch the sums the bucket belongs to.
+    """
+
+    def __init__(self, new):
+        self.new = new
+        self.localtime = LocalTime(new['tz'], new['timeline'][0] if new['timeline'] else None)
+        self.range_low, self.range_high = glucose_range(new['units'])
+        self.overall = Stats()
+        self.daily = []
+        self.dates = []
+        self.hourly = {}
+        self.wd_hourly = {}
+        self.wd_count = {}
+        for i in range(24):
+            self.hourly[i] = Stats()
+            for wd in range(7):
+                self.wd_hourly[(wd, i)] = Stats()
+                self.wd_count[wd] = 0
+        # index into daily of every bucket
+        self.day_of = []
+        self.last_day = None
+        if new['timeline']:
+            g = groups(new)
+            for i, day in enumerate(g['days'][g['day']].tolist()):
+                self.append(i, day)
+
+    def point(self, i):
+        new = self.new
+        # glucose of masked buckets was interpolated across a sensor
+        # gap, insulin and carbs are still real
+        sample = 1 if ('valid' not in new or new['valid'][i]) else 0
+        return Stats(
+            glucose = new['glucose'][i] * sample,
+            range_low = sample if new['glucose'][i] < self.range_low else 0,
+            range_high = sample if new['glucose'][i] > self.range_high else 0,
             insulin = new['insulin'][i],
             carbs = sum(x[i] for x in new['carbs'].values()),
             basal = new['basal'][i] + new['prog_basal'][i],
             prog_basal = new['prog_basal'][i],
-            samples = 1)
+            samples = sample,
+            buckets = 1)
+
+    def sums(self, i):
+        """The Stats bucket i is summed into."""
+        day = self.day_of[i]
+        hour = int(self.new['hours'][i])
+        return (self.daily[day], self.hourly[hour],
+                self.wd_hourly[(self.dates[day].weekday(), hour)], self.overall)
+
+    def append(self, i, day=None):
+        """Add bucket i, the next one, on local day (since the epoch)."""
+        if day is None:
+            day = int(self.localtime.days(self.new['timeline'][i]))
+        if day != self.last_day:
+            self.last_day = day
+            self.dates.append(LocalTime.date(day))
+            self.daily.append(Stats())
+            self.wd_count[self.dates[-1].weekday()] += 1
+        self.day_of.append(len(self.daily) - 1)
+        point = self.point(i)
+        for s in self.sums(i):
+            s.add(point)
+
+    def replace(self, i, old):
+        """Update the sums after bucket i changed, old is its point() before."""
+        point = self.point(i)
+        for s in self.sums(i):
+            s.sub(old)
+            s.add(point)
+
+    def format(self):
+        j = {
+          'tz': self.new['tz'],
+          'units': self.new['units']
+        }
+        daily = self.daily
+        days = len(daily)
+
+        insulin = [x['insulin'] for x in daily]
+        if insulin:
+            j['tdd'] = {
+                'avg': round(sum(insulin)/len(insulin), 1),
+                'weighted': round(0.6*sum(insulin)/len(insulin) + 0.4*insulin[-1], 1),
+                'yesterday': round(insulin[-1], 1)
+            }
+        j['overall'] = {
+            'total': self.overall.format({'days': days}),
+            'daily_average': sum(daily).format({'days': days}, days)
+        }
+        j['daily'] = [day.format({
+            'date': d.isoformat(),
+            'weekday': d.strftime('%a'),
+        }) for day, d in zip(daily, self.dates)]
+        j['hourly'] = [self.hourly[i].format({'hour': i}, days) for i in range(24)]
+
+
+        j['pattern'] = {}
+        for (desc, days) in WEEK_PARTS.items():
+            j['pattern'][desc] = []
+            allday = Stats()
+            for part, hours in DAYPARTS.items():
+                daypart = Stats()
+                daycount = 0
+                for wd in days:
+                    for h in hours:
+                        daypart += self.wd_hourly[(wd, h)]
+                    daycount += self.wd_count[wd]
+
+                if daycount > 0:
+                    j['pattern'][desc].append(daypart.format({
+                        'daytime': part,
+                    }, daycount))
+
+                allday.add(daypart)
+
+            alldaycount = sum(v for wd, v in self.wd_count.items() if wd in days)
+            if alldaycount > 0:
+                j['pattern'][desc].append(allday.format({
+                    'daytime': 'Daily',
+                }, alldaycount))
+
+        # for debugging mostly
+        j['weekdays'] = dict(self.wd_count)
+        return j
 
-        wd = lastdate.weekday()
-        hour = int(new['hours'][i])
 
-        stats_hourly[hour].add(point)
-        stats_wd_hourly[(wd, hour)].add(point)
+def stats(new):
+    return Aggregates(new).format()
+
+
+ROLLING_WINDOWS = (7, 14, 30)
+
+
+def gmi(avg, units):
+    """Glucose management indicator in % from the average glucose."""
+    avg_mgdl = avg if units == MGDL else avg * MGDL_TO_MMOL
+    return 3.31 + 0.02392 * avg_mgdl
+
+
+def rolling(new, windows=None):
+    """Trailing window metrics for every day of new.
+
+    Daily sums are built once, every window of every day is then a
+    difference of two prefix sums, so the cost does not depend on the
+    window lengths. Days at the start of the timeline use the days
+    available, see 'days' of each item.
+    """
+    windows = windows or ROLLING_WINDOWS
+    g = groups(new)
+    ndays = len(g['days'])
+    glucose = np.asarray(new['glucose'], dtype=np.float64)
+    valid = valid_mask(new)
+    range_low, range_high = glucose_range(new['units'])
+    daily = {
+        'samples': np.bincount(g['day'], valid, ndays),
+        'buckets': np.bincount(g['day'], minlength=ndays),
+        'glucose': np.bincount(g['day'], glucose * valid, ndays),
+        'range_low': np.bincount(g['day'], valid & (glucose < range_low), ndays),
+        'range_high': np.bincount(g['day'], valid & (glucose > range_high), ndays),
+        'insulin': np.bincount(g['day'], new['insulin'], ndays),
+    }
+    prefix = {k: np.concatenate(([0], np.cumsum(v))) for k, v in daily.items()}
+    end = np.arange(1, ndays + 1)
+    dates = [LocalTime.date(d).isoformat() for d in g['days']]
+
+    j = {}
+    for w in windows:
+        start = np.maximum(end - w, 0)
+        s = {k: p[end] - p[start] for k, p in prefix.items()}
+        samples = np.maximum(s['samples'], 1)
+        avg = s['glucose'] / samples
+        tir = 100 * (s['samples'] - s['range_low'] - s['range_high']) / samples
+        items = []
+        for i in range(ndays):
+            item = {'date': dates[i], 'days': int(end[i] - start[i])}
+            if s['samples'][i]:
+                item.update({
+                    'glucose': round(float(avg[i]), 1),
+                    'gmi': round(float(gmi(avg[i], new['units'])), 1),
+                    'range': round(float(tir[i]), 1),
+                    'range_low': round(float(100 * s['range_low'][i] / samples[i]), 1),
+                    'range_high': round(float(100 * s['range_high'][i] / samples[i]), 1),
+                })
+            else:
+                # unknown without valid samples, not 0
+                item.update(dict.fromkeys(('glucose', 'gmi', 'range', 'range_low', 'range_high')))
+            item['tdd'] = round(float(s['insulin'][i] / (end[i] - start[i])), 1)
+            item['coverage'] = round(float(100 * s['samples'][i] / s['buckets'][i]), 1)
+            items.append(item)
+        j[str(w)] = items
+    return {
+        'tz': new['tz'],
+        'units': new['units'],
+        'rolling': j,
+    }
 
-        day.add(point)
-        overall.add(point)
 
-    day.update({
-        'date': lastdate.isoformat(),
-        'weekday': lastdate.strftime('%a'),
-    })
-    daily.append(day)
-    days = len(daily)
-
-    insulin = [x['insulin'] for x in daily]
-    if insulin:
-        j['tdd'] = {
-            'avg': round(sum(insulin)/len(insulin), 1),
-            'weighted': round(0.6*sum(insulin)/len(insulin) + 0.4*insulin[-1], 1),
-            'yesterday': round(insulin[-1], 1)
+AGP_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def agp(new, bin_size=None):
+    """Ambulatory glucose profile: glucose percentiles per time of day.
+
+    Buckets are grouped into bins of bin_size seconds (default 15 minutes)
+    of local time, padded into a days x bins matrix and reduced with a
+    single nanpercentile call.
+    """
+    if bin_size is None:
+        bin_size = 900
+    if bin_size <= 0 or 86400 % bin_size:
+        raise ValueError('bin size %d does not divide a day' % bin_size)
+    nbins = 86400 // bin_size
+    valid = valid_mask(new)
+    glucose = np.asarray(new['glucose'], dtype=np.float64)[valid]
+    timeline = np.asarray(new['timeline'], dtype=np.int64)[valid]
+    bins = LocalTime(new['tz']).seconds(timeline) // bin_size
+    counts = np.bincount(bins, minlength=nbins)
+    # position of every sample within its bin, bins differ in length on
+    # days with a DST change
+    order = np.argsort(bins, kind='stable')
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(bins)) - np.repeat(starts, counts)
+    matrix = np.full((nbins, max(counts.max(initial=0), 1)), np.nan)
+    matrix[bins[order], rank] = glucose[order]
+    with warnings.catch_warnings():
+        # bins without any samples
+        warnings.simplefilter('ignore', RuntimeWarning)
+        p = np.nanpercentile(matrix, AGP_PERCENTILES, axis=1)
+
+    profile = []
+    for i in range(nbins):
+        minute = i * bin_size // 60
+        item = {
+            'time': '%02d:%02d' % (minute // 60, minute % 60),
+            'samples': int(counts[i]),
         }
-    j['overall'] = {
-        'total': overall.format({'days': days}),
-        'daily_average': sum(daily).format({'days': days}, days)
+        for j, q in enumerate(AGP_PERCENTILES):
+            item['p%d' % q] = None if not counts[i] else round(float(p[j][i]), 1)
+        profile.append(item)
+    return {
+        'tz': new['tz'],
+        'units': new['units'],
+        'bin_minutes': bin_size // 60,
+        'percentiles': list(AGP_PERCENTILES),
+        'agp': profile,
     }
-    j['daily'] = [day.format() for day in daily]
-    j['hourly'] = [stats_hourly[i].format({'hour': i}, days) for i in range(24)]
-
-
-    week = (0, 1, 2, 3, 4)
-    weekend = (5, 6)
-
-    dayparts = dict(
-        Night = (0, 1, 2, 3, 4, 5, 21, 22, 23),
-        Breakfast = (6, 7, 8, 9),
-        Snack = (10, 11),
-        Lunch = (12, 13),
-        SnackAfternoon = (14, 15, 16, 17),
-        Dinner = (18, 19, 20)
-    )
-
-    j['pattern'] = {}
-    for (desc, days) in (('Week', week), ('Weekend', weekend)):
-        j['pattern'][desc] = []
-        allday = Stats()
-        for part, hours in dayparts.items():
-            daypart = Stats()
-            daycount = 0
-            for wd in days:
-                for h in hours:
-                    daypart += stats_wd_hourly[(wd, h)]
-                daycount += wd_count[wd]
-
-            if daycount > 0:
-                j['pattern'][desc].append(daypart.format({
-                    'daytime': part,
-                }, daycount))
-
-            allday.add(daypart)
-
-        alldaycount = sum(v for wd, v in wd_count.items() if wd in days)
-        if alldaycount > 0:
-            j['pattern'][desc].append(allday.format({
-                'daytime': 'Daily',
-            }, alldaycount))
-
-    # for debugging mostly
-    j['weekdays'] = wd_count
-    return j
 
 
-def run(url, start, end, days, cache=True, token=None, hashed_secret=None,
-        bucket_size=None):
-  today = datetime.combine(date.today(), datetime.min.time())
-  dl = Nightscout(url, secret=None, token=token, hashed_secret=hashed_secret)
+# Coarser levels derived from the base resolution returned by convert().
+RESOLUTIONS = collections.OrderedDict((
+    ('15m', 900),
+    ('1h', 3600),
+    ('1d', 86400),
+))
+
+# How each timeline column is reduced when merging buckets.
+SUM_COLUMNS = ('prog_basal', 'bolus', 'basal', 'insulin')
+MEAN_COLUMNS = ('glucose', 'basal_rate', 'isf_schedule', 'carb_ratio_schedule')
+FIRST_COLUMNS = ('timeline', 'hours', 'iage', 'cage', 'sage')
+# the lists of new with one value per bucket, besides the carbs
+TIMELINE_COLUMNS = FIRST_COLUMNS + MEAN_COLUMNS + SUM_COLUMNS + ('valid',)
+
+
+def downsample(new, size):
+    """Reduce the timeline of new to buckets of size seconds.
+
+    Insulin and carbs are summed, glucose is averaged over the valid
+    buckets and timestamps, hours and age counters are taken from the first
+    bucket of each group. A bucket is valid if any of its group is.
+    Sizes of whole days group by local days, which are 23 or 25 hours long
+    at DST changes.
+    """
+    base = new['size']
+    if size < base or size % base:
+        raise ValueError('resolution %d is not a multiple of %d' % (size, base))
+    factor = size // base
+    n = len(new['timeline'])
+    if size % 86400 == 0 and n:
+        timeline = new['timeline']
+        days = LocalTime(new['tz'], timeline[0], timeline[-1]).days(timeline)
+        group = (days - days[0]) // (size // 86400)
+        starts = np.flatnonzero(np.diff(group, prepend=group[0] - 1))
+    else:
+        starts = np.arange(0, n, factor)
+    counts = np.diff(np.append(starts, n))
+
+    def reduce_sum(column):
+        if not n:
+            return []
+        return np.add.reduceat(np.asarray(column, dtype=float), starts).tolist()
+
+    level = dict(new)
+    level['size'] = size
+    for k in SUM_COLUMNS:
+        level[k] = reduce_sum(new[k])
+    for k in MEAN_COLUMNS:
+        level[k] = (np.asarray(reduce_sum(new[k])) / counts).tolist()
+    # glucose is averaged over the valid buckets only
+    valid = valid_mask(new)
+    samples = np.asarray(reduce_sum(valid))
+    glucose = np.asarray(reduce_sum(np.asarray(new['glucose']) * valid))
+    level['glucose'] = (glucose / np.maximum(samples, 1)).tolist()
+    level['valid'] = (samples > 0).tolist()
+    for k in FIRST_COLUMNS:
+        level[k] = np.asarray(new[k])[starts].tolist()
+    level['carbs'] = {a: reduce_sum(x) for a, x in new['carbs'].items()}
+    return level
+
+
+def pyramid(new, resolutions=None):
+    """Return all coarser levels of new, keyed by resolution name."""
+    levels = collections.OrderedDict()
+    for name, size in (resolutions or RESOLUTIONS).items():
+        if size > new['size'] and size % new['size'] == 0:
+            levels[name] = downsample(new, size)
+    return levels
+
+
+EXPORT_FORMATS = ('npz', 'arrow')
+
+
+def columns(new):
+    """Split new into equally long NumPy columns and a metadata dict.
+
+    Carbs are stored as one column per absorption time, named carbs_<min>.
+    """
+    cols = collections.OrderedDict()
+    cols['timeline'] = np.asarray(new['timeline'], dtype=np.int64)
+    for k in MEAN_COLUMNS + ('hours',) + SUM_COLUMNS + ('iage', 'cage', 'sage'):
+        cols[k] = np.asarray(new[k], dtype=np.float64)
+    cols['valid'] = valid_mask(new)
+    for absorption, x in sorted(new['carbs'].items()):
+        cols['carbs_%s' % absorption] = np.asarray(x, dtype=np.float64)
+    meta = {k: v for k, v in new.items()
+            if k not in cols and k != 'carbs'}
+    return cols, meta
+
+
+def export(new, fp, fmt):
+    """Write the timeline of new to the file object fp as npz or arrow.
+
+    Arrow files are written uncompressed so readers can memory map them
+    with pyarrow.memory_map(), npz members load without any parsing.
+    """
+    cols, meta = columns(new)
+    if fmt == 'npz':
+        np.savez(fp, metadata=np.array(json.dumps(meta)), **cols)
+    elif fmt == 'arrow':
+        import pyarrow
+        import pyarrow.ipc
+        table = pyarrow.table(cols).replace_schema_metadata(
+                {'nightscout': json.dumps(meta)})
+        with pyarrow.ipc.new_file(fp, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError('unknown export format %s' % fmt)
+
+
+def load(fn):
+    """Load an exported file, returns (columns, metadata).
+
+    Arrow columns are zero-copy views into the memory mapped file, except
+    the boolean valid column, which Arrow stores as bits.
+    """
+    if fn.endswith('.npz'):
+        with np.load(fn) as f:
+            cols = {k: f[k] for k in f.files}
+        meta = json.loads(str(cols.pop('metadata')))
+        return cols, meta
+    import pyarrow
+    import pyarrow.ipc
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(fn)).read_all()
+    cols = {}
+    for k in table.column_names:
+        column = table.column(k)
+        if column.num_chunks == 1:
+            column = column.chunk(0)
+        if pyarrow.types.is_boolean(column.type):
+            cols[k] = column.to_numpy(zero_copy_only=False)
+        else:
+            cols[k] = column.to_numpy()
+    return cols, json.loads(table.schema.metadata[b'nightscout'])
+
+
+def fetch(dl, url, days, cache=True, workers=None):
+  """Download what run() converts for the last days, through client dl."""
   host = url.replace('https://', '').replace('http://', '')
-  cache_fn = 'cache_%s_%s_%d.json' % (host, today.isoformat(), days)
+  cache_fn = 'cache_%s_%s_%d.json' % (host, date.today().isoformat(), days)
   j = {}
   try:
     j = json.loads(open(cache_fn).read())
@@ -623,47 +1558,143 @@ def run(url, start, end, days, cache=True, token=None, hashed_secret=None,
   profile = j.get('p') or dl.download('profile')
   defaultProfile = profile[0]['defaultProfile']
   tz = profile[0]['store'][defaultProfile]['timezone']
-  #today = today.replace(tzinfo=pytz.timezone(tz))
-  today = today.astimezone(pytz.timezone(tz))
-
-  startdate = today - timedelta(days=days)
-  enddate = startdate + timedelta(days=days)
+  # whole days in the time zone of the profile, not the one of this host
+  zone = pytz.timezone(tz)
+  today = datetime.combine(datetime.now(zone).date(), datetime.min.time())
+  startdate = zone.localize(today - timedelta(days=days))
+  enddate = zone.localize(today)
 
   # Retrieve slightly more than necessary to account for
   # temp basals starting the previous day
-  startdate_ns = (startdate - timedelta(hours=2)).astimezone(pytz.utc).isoformat()
-  enddate_ns = (enddate + timedelta(hours=1)).astimezone(pytz.utc).isoformat()
-
-  treatments = j.get('t') or dl.download(
+  startdate_ns = startdate - timedelta(hours=2)
+  enddate_ns = enddate + timedelta(hours=1)
+
+  # Windows are merged before conversion, so temp basals straddling a
+  # window boundary carry over like in a single download.
+  # The profile switch active at the start of the range is needed as
+  # well, the server returns the latest one first.
+  treatments = j.get('t') or (dl.download(
           'treatments',
-          {'find[created_at][$gte]': startdate_ns, 'find[created_at][$lte]':
-          enddate_ns, 'count': '10000'})
-  entries = j.get('e') or dl.download(
-          'entries',
-          {'find[dateString][$gte]': startdate_ns, 'find[dateString][$lte]:':
-          enddate_ns, 'count': '10000'})
+          {'find[eventType]': 'Profile Switch',
+           'find[created_at][$lt]': startdate_ns.astimezone(pytz.utc).isoformat(),
+           'count': '1'}) + dl.download_range(
+          'treatments', 'created_at', startdate_ns, enddate_ns, workers=workers))
+  entries = j.get('e') or dl.download_range(
+          'entries', 'dateString', startdate_ns, enddate_ns, workers=workers)
   if not j and cache:
     open(cache_fn, 'w').write(json.dumps({'p': profile, 'e': entries, 't': treatments}, indent=4, sort_keys=True))
-  return dl.convert(startdate, enddate, profile, entries, treatments, tz, bucket_size=bucket_size)
+  return startdate, enddate, profile, entries, treatments, tz
+
+
+def run(url, start, end, days, cache=True, token=None, hashed_secret=None,
+        bucket_size=None, workers=None, api=None, client=None, archive=None,
+        max_gap=None, processes=None):
+  dl = client or connect(url, api, token=token, hashed_secret=hashed_secret,
+                         archive=archive)
+  startdate, enddate, profile, entries, treatments, tz = fetch(
+          dl, url, days, cache=cache, workers=workers)
+  return dl.convert(startdate, enddate, profile, entries, treatments, tz,
+                    bucket_size=bucket_size, max_gap=max_gap, processes=processes)
 
 
 if __name__ == '__main__':
+  import argparse
 
   parser = argparse.ArgumentParser()
   parser.add_argument("--url", type=str, help="nightscout url")
   parser.add_argument("--secret", type=str, help="nightscout secret")
   parser.add_argument("--days", type=int, help="days to retrieve since yesterday")
+  parser.add_argument("--max-gap", type=int, default=MAX_GAP // 60,
+                      help="minutes without glucose entries masked as sensor gap")
+  parser.add_argument("--processes", type=int,
+                      help="convert in chunks of %d days with this many processes" % CHUNK_DAYS)
+  parser.add_argument("--parity", action="store_true",
+                      help="check the chunked conversion matches the serial one "
+                           "and the timeline has --days local days")
+  parser.add_argument("--synthetic", action="store_true",
+                      help="serve a synthetic site of --days locally instead of --url")
+  parser.add_argument("--api", type=str, default='v1', choices=('v1', 'v3', 'auto'),
+                      help="nightscout api version for entries and treatments")
+  parser.add_argument("--record", type=str,
+                      help="record all requests to this archive")
+  parser.add_argument("--replay", type=str,
+                      help="replay requests from this archive instead of the network")
+  parser.add_argument("--latency", action="store_true",
+                      help="delay replayed responses by the recorded time")
+  parser.add_argument("--resolution", action="append", default=[],
+                      choices=list(RESOLUTIONS),
+                      help="also write a coarser timeline, may be repeated")
+  parser.add_argument("--export", action="append", default=[],
+                      choices=EXPORT_FORMATS,
+                      help="also write the timeline in a binary format, may be repeated")
+  parser.add_argument("--compact", action="store_true",
+                      help="write the JSON files minified instead of indented")
   args = parser.parse_args()
+  if args.compact:
+    dump = lambda x: json.dumps(x, sort_keys=True, separators=(',', ':'))
+  else:
+    dump = lambda x: json.dumps(x, indent=4, sort_keys=True)
+
+  if args.synthetic:
+    import nightscout_autotune
+    import nightscout_synthetic
+    server = nightscout_autotune.serve(*nightscout_synthetic.synthetic_site(args.days))
+    args.url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+  archive = None
+  if args.record or args.replay:
+    import nightscout_replay
+    archive = nightscout_replay.Archive(
+            args.record or args.replay, 'record' if args.record else 'replay',
+            latency=args.latency)
 
-  ret, new, log = run(args.url, None, None, days=args.days)
+  try:
+    ret, new, log = run(args.url, None, None, days=args.days, api=args.api,
+                        cache=not (archive or args.synthetic), archive=archive,
+                        max_gap=args.max_gap * 60,
+                        processes=None if args.parity else args.processes)
+  finally:
+    # what was downloaded before a failure is worth replaying too
+    if args.record:
+      archive.save()
+
+  if args.parity:
+    chunked = run(args.url, None, None, days=args.days, api=args.api,
+                  cache=not (archive or args.synthetic), archive=archive,
+                  max_gap=args.max_gap * 60, processes=args.processes or 4)
+    for name, serial, parallel in zip(('ret', 'new'), (ret, new), chunked):
+      same = (json.dumps(serial, indent=4, sort_keys=True) ==
+              json.dumps(parallel, indent=4, sort_keys=True))
+      print('%s: %s' % (name, 'identical' if same else 'DIFFERENT'))
+      if not same:
+        sys.exit(1)
+    ndays = stats(new)['overall']['total']['days']
+    print('days: %d of %d' % (ndays, args.days))
+    if ndays != args.days:
+      sys.exit(1)
+
+  enddate = date.today()
+  startdate = enddate - timedelta(days=args.days)
 
   output_fn = 'ret_%s_%s.json' % (startdate, enddate)
-  open(output_fn, 'w').write(json.dumps(ret, indent=4, sort_keys=True))
+  open(output_fn, 'w').write(dump(ret))
 
   new_fn = 'new_%s_%s.json' % (startdate, enddate)
-  open(new_fn, 'w').write(json.dumps(new, indent=4, sort_keys=True))
+  open(new_fn, 'w').write(dump(new))
   print('')
   print('Written', new_fn)
 
+  for resolution in args.resolution:
+    level_fn = 'new_%s_%s_%s.json' % (startdate, enddate, resolution)
+    level = downsample(new, RESOLUTIONS[resolution])
+    open(level_fn, 'w').write(dump(level))
+    print('Written', level_fn)
+
+  for fmt in args.export:
+    export_fn = 'new_%s_%s.%s' % (startdate, enddate, fmt)
+    with open(export_fn, 'wb') as f:
+      export(new, f, fmt)
+    print('Written', export_fn)
+
   j = stats(new)
   print(json.dumps(j, indent=4))
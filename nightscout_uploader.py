@@ -19,8 +19,11 @@ import hashlib
 import json
 import os
 import pytz
-import urllib
-import urllib2
+import time
+try:
+  from urllib.request import Request, urlopen
+except ImportError:
+  from urllib2 import Request, urlopen
 
 
 class NoData(object):
@@ -29,11 +32,14 @@ class NoData(object):
 
 class NightscoutUploader(object):
 
-  def __init__(self, url=None, secret=None, device=None):
+  def __init__(self, url=None, secret=None, device=None, pause=5):
     self.url = url or os.environ.get('NIGHTSCOUT_URL')
-    self.secret = hashlib.sha1(secret or os.environ.get('NIGHTSCOUT_SECRET')).hexdigest()
+    secret = secret or os.environ.get('NIGHTSCOUT_SECRET')
+    self.secret = hashlib.sha1(secret.encode('utf-8')).hexdigest()
     self.batch = []
     self.device = device or 'nightscout_uploader_py'
+    # seconds to wait between batches
+    self.pause = pause
 
   def upload(self, path, data):
     batch = []
@@ -42,18 +48,18 @@ class NightscoutUploader(object):
       # Some rate limiting
       if len(batch) >= 1000:
         self._upload(path, batch)
-        time.sleep(5)
+        time.sleep(self.pause)
         batch = []
     return self._upload(path, batch)
 
   def _upload(self, path, data):
     if not data:
       return NoData
-    req = urllib2.Request(self.url + '/api/v1/' + path + '/')
+    req = Request(self.url + '/api/v1/' + path + '/')
     req.add_header('Content-Type', 'application/json')
     req.add_header('api-secret', self.secret)
-    print 'Upload batch', path, len(data)
-    response = urllib2.urlopen(req, json.dumps(data))
+    print('Upload batch %s %d' % (path, len(data)))
+    response = urlopen(req, json.dumps(data).encode('utf-8'))
     return response
 
   def date(self, date):
@@ -125,15 +131,18 @@ class NightscoutUploader(object):
     return self.upload('treatments', self._basal(data))
 
   def _basal(self, data):
-    first = data.next()
+    try:
+      first = next(data)
+    except StopIteration:
+      return
     batch = []
     while True:
       (date, basal) = first
       try:
-        next = data.next()
+        following = next(data)
       except StopIteration:
         break
-      duration = (next[0] - date).total_seconds()
+      duration = (following[0] - date).total_seconds()
       d = self.date(date)
       d = {
           'created_at': d['dateString'],
@@ -142,10 +151,10 @@ class NightscoutUploader(object):
           'enteredBy': self.device,
           'absolute': basal,
           'rate': basal,
-          'duration': int(duration) / 60,  # minutes!!
+          'duration': int(duration) // 60,  # minutes!!
       }
       yield d
-      first = next
+      first = following
 
   def upload_exercise(self, data):
     return self.upload('treatments', self._exercise(data)) 
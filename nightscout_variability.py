@@ -0,0 +1,206 @@
+"""
+Glycemic variability metrics of a converted Nightscout timeline.
+
+Computes SD, CV, MAGE, LBGI/HBGI, GRI and time in tight range from the
+bucketed glucose of nightscout_to_json.convert(), overall and grouped
+like stats() by day, hour and weekday part. Every metric is a bincount
+over the group indices, so the cost is linear in the number of buckets.
+
+Usage: ./nightscout_variability.py --benchmark [--days 365]
+"""
+"""
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import nightscout_to_json
+from nightscout_to_json import MGDL, MGDL_TO_MMOL, LocalTime
+
+
+# all thresholds in mg/dl
+TIGHT_RANGE = (70, 140)
+GRI_VERY_LOW = 54
+GRI_LOW = 70
+GRI_HIGH = 180
+GRI_VERY_HIGH = 250
+
+
+def risk(mgdl):
+    """Low and high blood glucose risk per sample (Kovatchev)."""
+    f = 1.509 * (np.log(np.maximum(mgdl, 1)) ** 1.084 - 5.381)
+    r = 10 * f * f
+    return np.where(f < 0, r, 0), np.where(f > 0, r, 0)
+
+
+def moving_average(x, window):
+    """Trailing moving average, shorter at the start."""
+    c = np.concatenate(([0], np.cumsum(x)))
+    end = np.arange(1, len(x) + 1)
+    start = np.maximum(end - window, 0)
+    return (c[end] - c[start]) / (end - start)
+
+
+def excursions(glucose, bucket_size):
+    """Start index and amplitude of every excursion.
+
+    Like the moving average method of iglu: where a short (25 min) and a
+    long (160 min) moving average cross, the glucose changes direction.
+    The extreme of each segment between crossings is a peak or nadir,
+    excursions are the differences of successive extremes.
+    """
+    if len(glucose) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    short = moving_average(glucose, max(1500 // bucket_size, 1))
+    long = moving_average(glucose, max(9600 // bucket_size, 1))
+    above = short > long
+    starts = np.concatenate(([0], np.flatnonzero(above[1:] != above[:-1]) + 1))
+    extremes = np.where(above[starts],
+                        np.maximum.reduceat(glucose, starts),
+                        np.minimum.reduceat(glucose, starts))
+    return starts[:-1], np.abs(np.diff(extremes))
+
+
+def grouped(glucose, mgdl, group, ngroups, swings):
+    """All metrics for every group, returns a list of dicts."""
+    def total(weights=None):
+        return np.bincount(group, weights, ngroups)
+
+    samples = total()
+    n = np.maximum(samples, 1)
+    mean = total(glucose) / n
+    var = np.maximum(total(glucose * glucose) - n * mean * mean, 0)
+    sd = np.sqrt(var / np.maximum(samples - 1, 1))
+    low_risk, high_risk = risk(mgdl)
+    lbgi = total(low_risk) / n
+    hbgi = total(high_risk) / n
+    percent = lambda mask: 100 * total(mask) / n
+    very_low = percent(mgdl < GRI_VERY_LOW)
+    low = percent(mgdl < GRI_LOW) - very_low
+    very_high = percent(mgdl > GRI_VERY_HIGH)
+    high = percent(mgdl > GRI_HIGH) - very_high
+    gri = np.minimum(3.0 * very_low + 2.4 * low + 1.6 * very_high + 0.8 * high, 100)
+    tight = percent((mgdl >= TIGHT_RANGE[0]) & (mgdl <= TIGHT_RANGE[1]))
+
+    # MAGE: mean of the excursions larger than one SD of their group
+    start, amplitude = swings
+    swing_group = group[start]
+    large = amplitude > sd[swing_group]
+    mage_count = np.bincount(swing_group[large], minlength=ngroups)
+    mage = np.bincount(swing_group[large], amplitude[large], ngroups) / np.maximum(mage_count, 1)
+
+    metrics = []
+    for i in range(ngroups):
+        metrics.append({
+            'samples': int(samples[i]),
+            'mean': round(float(mean[i]), 1),
+            'sd': round(float(sd[i]), 1),
+            'cv': round(float(100 * sd[i] / mean[i]), 1) if mean[i] else None,
+            'mage': round(float(mage[i]), 1) if mage_count[i] else None,
+            'lbgi': round(float(lbgi[i]), 2),
+            'hbgi': round(float(hbgi[i]), 2),
+            'gri': round(float(gri[i]), 1),
+            'tight_range': round(float(tight[i]), 1),
+        })
+    return metrics
+
+
+def variability(new):
+    """Variability metrics of new, overall, daily, hourly and by weekday part."""
+    # buckets masked as sensor gaps are left out entirely
+    valid = nightscout_to_json.valid_mask(new)
+    glucose = np.asarray(new['glucose'], dtype=np.float64)[valid]
+    mgdl = glucose if new['units'] == MGDL else glucose * MGDL_TO_MMOL
+    g = {k: v[valid] if k != 'days' else v
+         for k, v in nightscout_to_json.groups(new).items()}
+    swings = excursions(glucose, new['size'])
+
+    dayparts = list(nightscout_to_json.DAYPARTS.items())
+    weekparts = list(nightscout_to_json.WEEK_PARTS.items())
+    daypart_of_hour = np.zeros(24, dtype=np.int64)
+    for i, (part, hours) in enumerate(dayparts):
+        daypart_of_hour[list(hours)] = i
+    weekpart_of_day = np.zeros(7, dtype=np.int64)
+    for i, (desc, days) in enumerate(weekparts):
+        weekpart_of_day[list(days)] = i
+    pattern = weekpart_of_day[g['weekday']] * len(dayparts) + daypart_of_hour[g['hour']]
+
+    j = {
+        'tz': new['tz'],
+        'units': new['units'],
+        'overall': grouped(glucose, mgdl, np.zeros(len(glucose), dtype=np.int64), 1, swings)[0],
+    }
+    daily = grouped(glucose, mgdl, g['day'], len(g['days']), swings)
+    for day, m in zip(g['days'], daily):
+        m['date'] = LocalTime.date(day).isoformat()
+    j['daily'] = daily
+    hourly = grouped(glucose, mgdl, g['hour'], 24, swings)
+    for hour, m in enumerate(hourly):
+        m['hour'] = hour
+    j['hourly'] = hourly
+    parts = grouped(glucose, mgdl, pattern, len(weekparts) * len(dayparts), swings)
+    j['pattern'] = {}
+    for i, (desc, days) in enumerate(weekparts):
+        j['pattern'][desc] = []
+        for k, (part, hours) in enumerate(dayparts):
+            m = parts[i * len(dayparts) + k]
+            if m['samples']:
+                m['daytime'] = part
+                j['pattern'][desc].append(m)
+    return j
+
+
+def synthetic(days, bucket_size=300, units=MGDL):
+    """A timeline shaped like convert() output with random glucose."""
+    n = days * 86400 // bucket_size
+    rng = np.random.default_rng(1)
+    glucose = np.clip(150 + 60 * np.sin(np.arange(n) / 20.0) + rng.normal(0, 10, n), 40, 400)
+    if units != MGDL:
+        glucose = glucose / MGDL_TO_MMOL
+    timeline = 1700000000 + bucket_size * np.arange(n)
+    return {
+        'size': bucket_size,
+        'tz': 'Europe/Berlin',
+        'units': units,
+        'timeline': timeline.tolist(),
+        'glucose': glucose.tolist(),
+        'hours': LocalTime('Europe/Berlin').hours(timeline).tolist(),
+    }
+
+
+def benchmark(days, repeat=5):
+    for units in (MGDL, 'mmol'):
+        new = synthetic(days, units=units)
+        started = time.time()
+        for _ in range(repeat):
+            j = variability(new)
+        elapsed = (time.time() - started) / repeat
+        print('%d days, %d buckets, %s: %.1f ms, overall %s' % (
+            days, len(new['glucose']), units, 1000 * elapsed,
+            json.dumps(j['overall'])))
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--benchmark", action="store_true",
+                      help="time the metrics on synthetic data")
+  parser.add_argument("--days", type=int, nargs='+', default=[7, 90, 365])
+  args = parser.parse_args()
+
+  if args.benchmark:
+    for days in args.days:
+      benchmark(days)
@@ -19,7 +19,7 @@ if [ "x" == "x$URL" ]; then
   URL="$1"
 fi
 
-OUTPUT="$(cd /app/ && ./run_autotune.sh $URL)"
+OUTPUT="$(cd /app/ && python3 nightscout_autotune.py $URL)"
 
 env
 